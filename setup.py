@@ -8,7 +8,7 @@ setup(
     author='Merlintor',
     license='MIT',
     packages=find_packages(),
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     install_requires=[
         "aiohttp==3.6.2",
         "aiormq==3.2.0",
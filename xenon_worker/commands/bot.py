@@ -1,5 +1,7 @@
 from ..connection.rabbit import RabbitClient
 from ..connection.entities import Message
+from ..connection.scheduler import request_scope
+from ..connection.errors import DeadlineExceeded
 from .command import CommandTable
 from .context import Context
 from .module import Listener
@@ -14,10 +16,11 @@ from datetime import datetime, timedelta
 
 
 class RabbitBot(RabbitClient, CommandTable):
-    def __init__(self, prefix, *args, **kwargs):
+    def __init__(self, prefix, *args, command_timeout=None, **kwargs):
         RabbitClient.__init__(self, *args, **kwargs)
         CommandTable.__init__(self)
         self.prefix = prefix
+        self.command_timeout = command_timeout
         self.static_listeners = {}
         self.modules = []
         self.f = Formatter()
@@ -66,7 +69,9 @@ class RabbitBot(RabbitClient, CommandTable):
 
         ctx = Context(self, shard_id, msg)
         try:
-            await cmd.execute(ctx, parts)
+            # All requests made by the command are queued fairly with other guilds
+            with request_scope(key=bucket, deadline=ctx.deadline):
+                await cmd.execute(ctx, parts)
         except Exception as e:
             self.dispatch("command_error", cmd, ctx, e)
 
@@ -87,6 +92,10 @@ class RabbitBot(RabbitClient, CommandTable):
         if isinstance(e, asyncio.CancelledError):
             return
 
+        if isinstance(e, DeadlineExceeded):
+            # Nobody is waiting for a response anymore
+            return
+
         if isinstance(e, FormatRaise):
             await ctx.f_send(*e.args, **e.kwargs, f=e.f)
             return
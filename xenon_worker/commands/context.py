@@ -1,4 +1,6 @@
 from ..connection.entities import Snowflake
+from ..connection.scheduler import Priority, request_scope
+import time
 
 
 class Context:
@@ -7,6 +9,10 @@ class Context:
         self.shard_id = shard_id
         self.msg = msg
 
+        # Requests made by the command are dropped if they couldn't be sent before the deadline
+        timeout = getattr(client, "command_timeout", None)
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+
         self.last_cmd = None  # Filled by cmd.execute
 
         self._guild = None
@@ -66,11 +72,14 @@ class Context:
     async def get_guild_roles(self):
         return await self.client.get_guild_roles(self.msg.guild_id)
 
-    def f_send(self, *args, **kwargs):
-        return self.bot.f_send(Snowflake(self.msg.channel_id), *args, **kwargs)
+    async def f_send(self, *args, **kwargs):
+        # Replies to the user skip the queue of normal and bulk requests
+        with request_scope(priority=Priority.INTERACTIVE):
+            return await self.bot.f_send(Snowflake(self.msg.channel_id), *args, **kwargs)
 
-    def send_message(self, *args, **kwargs):
-        return self.client.send_message(Snowflake(self.msg.channel_id), *args, **kwargs)
+    async def send_message(self, *args, **kwargs):
+        with request_scope(priority=Priority.INTERACTIVE):
+            return await self.client.send_message(Snowflake(self.msg.channel_id), *args, **kwargs)
 
     def send(self, *args, **kwargs):
         return self.send_message(*args, **kwargs)
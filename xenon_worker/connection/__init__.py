@@ -3,3 +3,4 @@ from .enums import *
 from .errors import *
 from .rabbit import RabbitClient
 from .httpd import Route, File
+from .scheduler import Priority, request_scope
@@ -0,0 +1,153 @@
+import logging
+import time
+import copy
+from collections import OrderedDict
+
+from . import utils
+
+log = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Opt-in TTL cache for idempotent GET requests
+
+    Routes have to be enabled one by one with a ttl. Responses are kept in a bounded in-memory LRU and,
+    if redis is set, also in redis so they can be shared between workers.
+    Every entry is tagged with the parameters of its route, which is used to invalidate all entries that
+    belong to e.g. a channel or a guild when the matching update event is received.
+    """
+
+    def __init__(self, redis=None, *, maxsize=10000, prefix='http:cache'):
+        self.redis = redis
+        self.maxsize = maxsize
+        self.prefix = prefix
+        self.ttls = {}
+
+        # key -> (expires, data, tags)
+        self._entries = OrderedDict()
+        # tag -> set of keys
+        self._tags = {}
+
+    def enable(self, method, path, ttl):
+        self.ttls['%s:%s' % (method, path)] = ttl
+
+    def disable(self, method, path):
+        self.ttls.pop('%s:%s' % (method, path), None)
+
+    def ttl_for(self, route):
+        return self.ttls.get(route.label)
+
+    def caches(self, parameter):
+        """
+        Returns True if a route with the parameter (e.g. guild_id) is cached
+        """
+        placeholder = '{%s}' % parameter
+        return any(placeholder in label for label in self.ttls)
+
+    @staticmethod
+    def _tags_for(route):
+        return {'%s:%s' % (k, v) for k, v in route.parameters.items()}
+
+    def _redis_key(self, key):
+        url, params = key
+        if params:
+            url += '?' + '&'.join('%s=%s' % p for p in params)
+
+        return '%s:%s' % (self.prefix, url)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    async def get(self, route, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return copy.deepcopy(entry[1])
+
+            self._drop(key)
+
+        if self.redis is None:
+            return None
+
+        try:
+            raw = await self.redis.get(self._redis_key(key))
+        except Exception as e:
+            log.warning('Failed to get cached response (%s: %s)', e.__class__.__name__, e)
+            return None
+
+        if raw is None:
+            return None
+
+        data = utils.from_json(raw)
+        self._store(key, data, self.ttl_for(route) or 0, self._tags_for(route))
+        return data
+
+    def _store(self, key, data, ttl, tags):
+        self._drop(key)
+        self._entries[key] = (time.monotonic() + ttl, copy.deepcopy(data), tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+        while len(self._entries) > self.maxsize:
+            self._drop(next(iter(self._entries)))
+
+    async def set(self, route, key, data):
+        ttl = self.ttl_for(route)
+        if ttl is None:
+            return
+
+        tags = self._tags_for(route)
+        self._store(key, data, ttl, tags)
+        if self.redis is None:
+            return
+
+        redis_key = self._redis_key(key)
+        tr = self.redis.multi_exec()
+        tr.set(redis_key, utils.to_json_bytes(data), pexpire=int(ttl * 1000))
+        for tag in tags:
+            tr.sadd('%s:tags:%s' % (self.prefix, tag), redis_key)
+            tr.expire('%s:tags:%s' % (self.prefix, tag), int(ttl) + 60)
+
+        try:
+            await tr.execute()
+        except Exception as e:
+            log.warning('Failed to cache response (%s: %s)', e.__class__.__name__, e)
+
+    async def invalidate(self, **parameters):
+        """
+        Removes all cached responses of routes that have all of the given parameters
+
+        e.g. invalidate(guild_id=...) or invalidate(guild_id=..., member_id=...)
+        """
+        tags = ['%s:%s' % (k, v) for k, v in parameters.items() if v is not None]
+        if not tags:
+            return
+
+        keys = set.intersection(*(self._tags.get(tag, set()) for tag in tags))
+        for key in keys:
+            self._drop(key)
+
+        if self.redis is None:
+            return
+
+        try:
+            redis_keys = await self.redis.sinter(*['%s:tags:%s' % (self.prefix, tag) for tag in tags])
+            if redis_keys:
+                await self.redis.delete(*redis_keys)
+        except Exception as e:
+            log.warning('Failed to invalidate cached responses (%s: %s)', e.__class__.__name__, e)
+
+    def clear(self):
+        self._entries.clear()
+        self._tags.clear()
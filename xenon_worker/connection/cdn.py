@@ -0,0 +1,372 @@
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+from . import utils
+from .errors import HTTPException, Forbidden, NotFound
+
+log = logging.getLogger(__name__)
+
+
+class CDNCache:
+    """
+    Size bounded, content-addressed on-disk cache for CDN assets
+
+    Every asset is stored once under the sha256 of its content in ``<root>/objects``, so the same emoji or icon
+    that is referenced by different urls (or repeated backups) only takes up space once. ``<root>/urls`` maps
+    each url to the digest of its content and the validators (ETag, Last-Modified) of the response.
+    Objects are evicted in least recently used order when the cache grows beyond `max_size` bytes. The access
+    time of an object is its mtime, so the order survives restarts.
+    All file operations of the coroutines run in the default executor.
+    """
+
+    def __init__(self, root, *, max_size=2 ** 30, max_age=86400, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.root = root
+        self.max_size = max_size
+        self.max_age = max_age
+        self.size = 0
+
+        self._objects = OrderedDict()
+        self._urls = {}
+        self._loading = None
+        self.loaded = False
+
+        for directory in ('objects', 'urls', 'tmp'):
+            os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def _url_path(self, url):
+        return os.path.join(self.root, 'urls', hashlib.sha1(url.encode()).hexdigest())
+
+    def _run(self, func, *args):
+        return self.loop.run_in_executor(None, func, *args)
+
+    @staticmethod
+    def _scan(root):
+        objects = []
+        for directory in os.scandir(os.path.join(root, 'objects')):
+            if not directory.is_dir():
+                continue
+
+            for entry in os.scandir(directory.path):
+                stat = entry.stat()
+                objects.append((stat.st_mtime, entry.name, stat.st_size))
+
+        objects.sort()
+        return objects
+
+    async def _load(self):
+        objects = await self._run(self._scan, self.root)
+        # Objects that were written while scanning are newer than everything that was on disk
+        current = self._objects
+        self._objects = OrderedDict((digest, size) for _, digest, size in objects if digest not in current)
+        self._objects.update(current)
+        self.size = sum(self._objects.values())
+        self.loaded = True
+        await self.evict()
+
+    async def load(self):
+        """
+        Scans the cache directory once to restore the size and the LRU order
+        """
+        if self._loading is None:
+            self._loading = self.loop.create_task(self._load())
+
+        try:
+            await asyncio.shield(self._loading)
+        except Exception:
+            # Let the next call try again
+            if self._loading.done():
+                self._loading = None
+
+            raise
+
+    def _read_meta(self, url):
+        try:
+            with open(self._url_path(url), 'rb') as f:
+                return utils.from_json(f.read())
+        except (OSError, ValueError):
+            return None
+
+    async def lookup(self, url):
+        """
+        Returns the metadata of a cached url or None
+        """
+        meta = self._urls.get(url)
+        if meta is None:
+            meta = await self._run(self._read_meta, url)
+            if meta is None:
+                return None
+
+        if meta['digest'] not in self._objects:
+            # The object was evicted
+            self._urls.pop(url, None)
+            return None
+
+        self._urls[url] = meta
+        return meta
+
+    def fresh(self, meta):
+        return time.time() - meta['checked'] < self.max_age
+
+    def path(self, meta):
+        return self._object_path(meta['digest'])
+
+    @staticmethod
+    def _utime(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    async def touch(self, meta):
+        digest = meta['digest']
+        self._objects.move_to_end(digest)
+        await self._run(self._utime, self._object_path(digest))
+
+    def _write_meta(self, url, meta):
+        tmp = os.path.join(self.root, 'tmp', uuid.uuid4().hex)
+        with open(tmp, 'wb') as f:
+            f.write(utils.to_json_bytes(meta))
+
+        os.replace(tmp, self._url_path(url))
+
+    async def store(self, url, meta):
+        self._urls[url] = meta
+        await self._run(self._write_meta, url, meta)
+
+    @staticmethod
+    def _discard(path):
+        if os.path.exists(path):
+            os.unlink(path)
+
+    @staticmethod
+    def _move(tmp, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+
+    async def write(self, stream, chunk_size=2 ** 16):
+        """
+        Writes the content of a stream to the cache and returns its digest
+        """
+        digest = hashlib.sha256()
+        size = 0
+        tmp = os.path.join(self.root, 'tmp', uuid.uuid4().hex)
+        try:
+            f = await self._run(open, tmp, 'wb')
+            try:
+                async for chunk in stream.iter_chunked(chunk_size):
+                    digest.update(chunk)
+                    await self._run(f.write, chunk)
+                    size += len(chunk)
+            finally:
+                await self._run(f.close)
+
+            digest = digest.hexdigest()
+            if digest in self._objects:
+                # We already have the same content from another url
+                await self._run(os.unlink, tmp)
+            else:
+                await self._run(self._move, tmp, self._object_path(digest))
+                self._objects[digest] = size
+                self.size += size
+
+        except BaseException:
+            await asyncio.shield(self._run(self._discard, tmp))
+            raise
+
+        self._objects.move_to_end(digest)
+        await self.evict()
+        return digest
+
+    def _pop_evicted(self):
+        paths = []
+        while self.size > self.max_size and len(self._objects) > 1:
+            digest, size = self._objects.popitem(last=False)
+            self.size -= size
+            paths.append(self._object_path(digest))
+            log.debug('Evicted %s (%s bytes) from the cdn cache', digest, size)
+
+        return paths
+
+    @staticmethod
+    def _unlink(paths):
+        for path in paths:
+            try:
+                # Files that are still mapped stay readable until they are unmapped
+                os.unlink(path)
+            except OSError:
+                pass
+
+    async def evict(self):
+        paths = self._pop_evicted()
+        if paths:
+            await self._run(self._unlink, paths)
+
+    def collect(self, metrics):
+        metrics.gauge("cdn:cache:size", self.size)
+        metrics.gauge("cdn:cache:objects", len(self._objects))
+
+
+class CDNFetcher:
+    """
+    Downloads assets from the CDN
+
+    Downloads use their own connection pool and at most `concurrency` of them run at the same time,
+    so they can't slow down API requests. Concurrent requests for the same url share one download.
+    If a cache is set, assets are streamed to disk instead of being buffered in memory, and cached entries
+    older than the max age of the cache are revalidated with a conditional request.
+    """
+
+    def __init__(self, pools, cache=None, *, concurrency=10, metrics=None, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.pools = pools
+        self.cache = cache
+        self.metrics = metrics
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        self._pending = {}
+        if cache is not None and metrics is not None:
+            metrics.add_collector(cache.collect)
+
+    def _incr(self, field):
+        if self.metrics is not None:
+            self.metrics.incr("cdn", field)
+
+    @staticmethod
+    def _raise_for_status(resp):
+        if resp.status == 404:
+            raise NotFound(resp, 'asset not found')
+        elif resp.status == 403:
+            raise Forbidden(resp, 'cannot retrieve asset')
+        else:
+            raise HTTPException(resp, 'failed to get asset')
+
+    async def fetch(self, url):
+        """
+        Returns the path of the cached asset, or its content if there is no cache
+        """
+        if self.cache is not None and not self.cache.loaded:
+            await self.cache.load()
+
+        task = self._pending.get(url)
+        if task is None:
+            task = self._pending[url] = self.loop.create_task(self._fetch(url))
+            task.add_done_callback(lambda t: self._fetch_done(url, t))
+
+        return await asyncio.shield(task)
+
+    def _fetch_done(self, url, task):
+        self._pending.pop(url, None)
+        if not task.cancelled():
+            task.exception()
+
+    async def _fetch(self, url):
+        if self.cache is None:
+            async with self.semaphore:
+                self._incr("miss")
+                async with self.pools.cdn.get(url) as resp:
+                    if resp.status == 200:
+                        return await resp.read()
+
+                    self._raise_for_status(resp)
+
+        meta = await self.cache.lookup(url)
+        headers = {}
+        if meta is not None:
+            if self.cache.fresh(meta):
+                self._incr("hit")
+                await self.cache.touch(meta)
+                return self.cache.path(meta)
+
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        async with self.semaphore:
+            async with self.pools.cdn.get(url, headers=headers) as resp:
+                if resp.status == 304 and meta is not None:
+                    self._incr("revalidated")
+                    meta['checked'] = time.time()
+                    await self.cache.store(url, meta)
+                    await self.cache.touch(meta)
+                    return self.cache.path(meta)
+
+                if resp.status != 200:
+                    self._raise_for_status(resp)
+
+                self._incr("miss")
+                digest = await self.cache.write(resp.content)
+                meta = {
+                    'digest': digest,
+                    'etag': resp.headers.get('ETag'),
+                    'last_modified': resp.headers.get('Last-Modified'),
+                    'checked': time.time()
+                }
+                await self.cache.store(url, meta)
+                return self.cache.path(meta)
+
+    @staticmethod
+    def _read_file(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def _map_file(path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    async def read(self, url):
+        result = await self.fetch(url)
+        if isinstance(result, bytes):
+            return result
+
+        return await self.loop.run_in_executor(None, self._read_file, result)
+
+    async def open(self, url):
+        """
+        Returns a read-only memory map of the asset (or its content if there is no cache)
+        """
+        result = await self.fetch(url)
+        if isinstance(result, bytes):
+            return result
+
+        return await self.loop.run_in_executor(None, self._map_file, result)
+
+    async def stream(self, url, chunk_size=2 ** 16):
+        """
+        Yields the asset in chunks without loading all of it into memory
+        """
+        if self.cache is not None:
+            path = await self.fetch(url)
+            f = await self.loop.run_in_executor(None, open, path, 'rb')
+            try:
+                while True:
+                    chunk = await self.loop.run_in_executor(None, f.read, chunk_size)
+                    if not chunk:
+                        return
+
+                    yield chunk
+            finally:
+                f.close()
+
+        async with self.semaphore:
+            self._incr("miss")
+            async with self.pools.cdn.get(url) as resp:
+                if resp.status != 200:
+                    self._raise_for_status(resp)
+
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    yield chunk
@@ -0,0 +1,134 @@
+import asyncio
+import copy
+import logging
+
+from .scheduler import without_deadline
+
+log = logging.getLogger(__name__)
+
+# Fields of a channel edit that the bulk endpoint can update
+_POSITION_FIELDS = frozenset(('position', 'parent_id', 'lock_permissions'))
+
+
+class _Batch:
+    __slots__ = ('payload', 'waiters')
+
+    def __init__(self):
+        self.payload = {}
+        self.waiters = []
+
+
+class MutationCoalescer:
+    """
+    Buffers edits for a few milliseconds and sends them in as few requests as possible
+
+    Position changes of channels and roles in the same guild are merged into a single request to the bulk
+    endpoints (bulk_channel_update and move_role_position). Several edits of the same channel or role
+    are merged into a single PATCH, later edits overwrite the fields of earlier ones. Every caller gets the
+    result of the request its edit was part of, or its exception.
+    """
+
+    def __init__(self, http, *, window=0.005, metrics=None, loop=None):
+        self.http = http
+        self.window = window
+        self.metrics = metrics
+        self.loop = loop or asyncio.get_event_loop()
+        self._batches = {}
+
+    def _enqueue(self, key, update, select=None):
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch()
+            # The flush runs with the priority and queue key of the first edit, but not with its deadline
+            self.loop.call_later(self.window, lambda: self.loop.create_task(without_deadline(self._flush(key))))
+
+        update(batch.payload)
+        future = self.loop.create_future()
+        batch.waiters.append((future, select))
+        return future
+
+    async def _flush(self, key):
+        batch = self._batches.pop(key)
+        kind, *args = key
+        try:
+            if kind == 'channel':
+                channel_id, reason = args
+                result = await self.http.edit_channel(channel_id, reason=reason, **batch.payload)
+            elif kind == 'role':
+                guild_id, role_id, reason = args
+                result = await self.http.edit_role(guild_id, role_id, reason=reason, **batch.payload)
+            elif kind == 'channel_positions':
+                guild_id, reason = args
+                result = await self.http.bulk_channel_update(guild_id, list(batch.payload.values()), reason=reason)
+            else:
+                guild_id, reason = args
+                result = await self.http.move_role_position(guild_id, list(batch.payload.values()), reason=reason)
+
+        except Exception as e:
+            for future, _ in batch.waiters:
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        if self.metrics is not None:
+            self.metrics.incr("coalesce", "requests")
+            self.metrics.incr("coalesce", "edits", len(batch.waiters))
+
+        if len(batch.waiters) > 1:
+            log.debug('Coalesced %s edits into one request (%s)', len(batch.waiters), kind)
+
+        for i, (future, select) in enumerate(batch.waiters):
+            if future.done():
+                continue
+
+            value = select(result) if select is not None else result
+            # Entities might modify the data, every waiter gets its own copy
+            future.set_result(value if i == 0 else copy.deepcopy(value))
+
+    def edit_channel(self, channel_id, *, guild_id=None, reason=None, **fields):
+        """
+        Edits a channel, edits that change the position (and maybe the parent) go through the bulk endpoint
+        if guild_id is passed
+        """
+        # The bulk endpoint needs a position for every channel
+        if guild_id is not None and 'position' in fields and set(fields) <= _POSITION_FIELDS:
+            return self.move_channel(guild_id, channel_id, reason=reason, **fields)
+
+        return self._enqueue(('channel', channel_id, reason), lambda payload: payload.update(fields))
+
+    def move_channel(self, guild_id, channel_id, position, *, parent_id=None, lock_permissions=None, reason=None):
+        entry = {'id': channel_id, 'position': position}
+        if parent_id is not None:
+            entry['parent_id'] = parent_id
+        if lock_permissions is not None:
+            entry['lock_permissions'] = lock_permissions
+
+        def _update(payload):
+            payload.setdefault(channel_id, {}).update(entry)
+
+        return self._enqueue(('channel_positions', guild_id, reason), _update)
+
+    def edit_role(self, guild_id, role_id, *, reason=None, **fields):
+        """
+        Edits a role, edits that only change the position go through the bulk endpoint
+        """
+        if set(fields) == {'position'}:
+            return self.move_role(guild_id, role_id, fields['position'], reason=reason)
+
+        return self._enqueue(('role', guild_id, role_id, reason), lambda payload: payload.update(fields))
+
+    def move_role(self, guild_id, role_id, position, *, reason=None):
+        def _update(payload):
+            payload[role_id] = {'id': role_id, 'position': position}
+
+        def _select(roles):
+            # The bulk endpoint returns all roles of the guild
+            if isinstance(roles, list):
+                for role in roles:
+                    if role.get('id') == role_id:
+                        return role
+
+            return roles
+
+        return self._enqueue(('role_positions', guild_id, reason), _update, _select)
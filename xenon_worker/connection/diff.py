@@ -0,0 +1,362 @@
+"""
+Computes the mutations that turn a live guild into a snapshot of it
+
+Objects are matched by id first (restoring into the same guild), then by name (and type and parent for
+channels), preferring the candidate with the closest position. Matched objects are only updated if they
+actually differ, so restoring a backup over a guild that hasn't changed much only costs a few requests.
+"""
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+REORDER = 'reorder'
+
+ROLE_FIELDS = ('name', 'permissions', 'color', 'hoist', 'mentionable')
+CHANNEL_FIELDS = ('name', 'topic', 'nsfw', 'bitrate', 'user_limit', 'rate_limit_per_user')
+
+CATEGORY = 4
+
+
+class Operation:
+    """
+    A single mutation of the live guild
+
+    `source` is the object from the snapshot, `target` the live object. `changes` are the fields that need
+    to be sent, they still contain snapshot ids (e.g. of parents and overwrites) which are mapped when the
+    diff is applied. Reorder operations have a list of (source, target) pairs and their new positions.
+    """
+    __slots__ = ('kind', 'type', 'source', 'target', 'changes')
+
+    def __init__(self, kind, type, source=None, target=None, changes=None):
+        self.kind = kind
+        self.type = type
+        self.source = source
+        self.target = target
+        self.changes = changes or {}
+
+    def __repr__(self):
+        obj = self.source if self.source is not None else self.target
+        name = obj.get('name') if obj is not None else None
+        return '<Operation {0.kind} {0.type} {1!r} {2}>'.format(self, name, sorted(self.changes))
+
+
+def _data(entity):
+    return entity.to_dict() if hasattr(entity, 'to_dict') else entity
+
+
+def _position(entity):
+    return _data(entity).get('position') or 0
+
+
+def _match(sources, targets, mapping, key, target_key=None):
+    """
+    Matches unmatched sources and targets with the same key, preferring targets with a close position
+    """
+    target_key = target_key or key
+    candidates = {}
+    for target in targets:
+        candidates.setdefault(target_key(target), []).append(target)
+
+    for source in sources:
+        if source['id'] in mapping:
+            continue
+
+        fit = candidates.get(key(source))
+        if not fit:
+            continue
+
+        best = min(fit, key=lambda t: abs(_position(t) - _position(source)))
+        fit.remove(best)
+        mapping[source['id']] = best
+
+
+class GuildDiff:
+    """
+    Result of :func:`diff_guild`
+
+    `role_map` and `channel_map` map snapshot ids to the matched live objects.
+    """
+
+    def __init__(self, source_guild, target_guild):
+        self.source_guild = source_guild
+        self.target_guild = target_guild
+        self.roles = []
+        self.channels = []
+        self.role_map = {}
+        self.channel_map = {}
+
+    @property
+    def operations(self):
+        return self.roles + self.channels
+
+    def __len__(self):
+        return len(self.roles) + len(self.channels)
+
+    def summary(self):
+        counts = {}
+        for op in self.operations:
+            key = '%s %s' % (op.kind, op.type)
+            counts[key] = counts.get(key, 0) + 1
+
+        return counts
+
+    # computing
+
+    def _diff_roles(self, sources, targets):
+        sources = [_data(r) for r in sources]
+        targets = [_data(r) for r in targets]
+        source_guild_id, target_guild_id = self.source_guild['id'], self.target_guild['id']
+
+        mapping = self.role_map
+        by_id = {t['id']: t for t in targets}
+        for source in sources:
+            # The default role has the id of the guild
+            if source['id'] == source_guild_id:
+                if target_guild_id in by_id:
+                    mapping[source['id']] = by_id[target_guild_id]
+            elif source['id'] in by_id:
+                mapping[source['id']] = by_id[source['id']]
+
+        matched = {t['id'] for t in mapping.values()}
+        # Roles of bots are managed by discord and can't be created, edited or deleted
+        unmatched = [t for t in targets if t['id'] not in matched and not t.get('managed')]
+        _match(sources, unmatched, mapping, key=lambda r: r['name'])
+        matched = {t['id'] for t in mapping.values()}
+
+        reorder = []
+        for source in sorted(sources, key=_position):
+            if source.get('managed'):
+                continue
+
+            target = mapping.get(source['id'])
+            if target is None:
+                self.roles.append(Operation(CREATE, 'role', source, changes={
+                    k: source.get(k) for k in ROLE_FIELDS
+                }))
+                if source['id'] != source_guild_id:
+                    reorder.append((source, None, _position(source)))
+                continue
+
+            changes = {
+                k: source.get(k) for k in ROLE_FIELDS
+                if k != 'name' or source['id'] != source_guild_id
+                if str(source.get(k)) != str(target.get(k))
+            }
+            if changes:
+                self.roles.append(Operation(UPDATE, 'role', source, target, changes))
+
+            if source['id'] != source_guild_id and _position(source) != _position(target):
+                reorder.append((source, target, _position(source)))
+
+        for target in targets:
+            if target['id'] not in matched and target['id'] != target_guild_id and not target.get('managed'):
+                self.roles.append(Operation(DELETE, 'role', target=target))
+
+        if reorder:
+            self.roles.append(Operation(REORDER, 'role', changes={'positions': reorder}))
+
+    @staticmethod
+    def _overwrites(channel):
+        return sorted(
+            (o['id'], o['type'], str(o['allow']), str(o['deny']))
+            for o in channel.get('permission_overwrites', [])
+        )
+
+    def _map_overwrites(self, source):
+        """
+        Returns the overwrites of a source channel with the ids of matched live roles
+        """
+        result = []
+        for target_id, type, allow, deny in self._overwrites(source):
+            role = self.role_map.get(target_id)
+            if role is not None:
+                target_id = role['id']
+            elif target_id == self.source_guild['id']:
+                target_id = self.target_guild['id']
+
+            result.append((target_id, type, allow, deny))
+
+        return sorted(result)
+
+    def _diff_channels(self, sources, targets):
+        sources = [_data(c) for c in sources]
+        targets = [_data(c) for c in targets]
+        mapping = self.channel_map
+        by_id = {t['id']: t for t in targets}
+        for source in sources:
+            if source['id'] in by_id and by_id[source['id']]['type'] == source['type']:
+                mapping[source['id']] = by_id[source['id']]
+
+        # Categories first, so the parents of channels can be compared
+        categories = [s for s in sources if s['type'] == CATEGORY]
+        matched = {t['id'] for t in mapping.values()}
+        unmatched = [t for t in targets if t['id'] not in matched]
+        _match(categories, [t for t in unmatched if t['type'] == CATEGORY], mapping,
+               key=lambda c: c['name'])
+
+        def _parent(source):
+            # The parent of a source channel as it's called in the live guild
+            parent = source.get('parent_id')
+            if parent is not None:
+                target = mapping.get(parent)
+                return target['id'] if target is not None else ('new', parent)
+
+            return parent
+
+        matched = {t['id'] for t in mapping.values()}
+        unmatched = [t for t in targets if t['id'] not in matched and t['type'] != CATEGORY]
+        _match(
+            [s for s in sources if s['type'] != CATEGORY],
+            unmatched,
+            mapping,
+            key=lambda c: (c['type'], c['name'], _parent(c)),
+            target_key=lambda c: (c['type'], c['name'], c.get('parent_id'))
+        )
+        matched = {t['id'] for t in mapping.values()}
+
+        reorder = []
+        for source in sorted(sources, key=lambda c: (c['type'] != CATEGORY, _position(c))):
+            target = mapping.get(source['id'])
+            if target is None:
+                changes = {k: source.get(k) for k in CHANNEL_FIELDS if source.get(k) is not None}
+                changes['type'] = source['type']
+                changes['parent_id'] = source.get('parent_id')
+                changes['permission_overwrites'] = source.get('permission_overwrites', [])
+                changes['position'] = _position(source)
+                self.channels.append(Operation(CREATE, 'channel', source, changes=changes))
+                continue
+
+            changes = {
+                k: source.get(k) for k in CHANNEL_FIELDS
+                if source.get(k) is not None and source.get(k) != target.get(k)
+            }
+            if _parent(source) != target.get('parent_id'):
+                changes['parent_id'] = source.get('parent_id')
+
+            if self._map_overwrites(source) != self._overwrites(target):
+                changes['permission_overwrites'] = source.get('permission_overwrites', [])
+
+            if changes:
+                self.channels.append(Operation(UPDATE, 'channel', source, target, changes))
+
+            if _position(source) != _position(target):
+                reorder.append((source, target, _position(source)))
+
+        for target in targets:
+            if target['id'] not in matched:
+                self.channels.append(Operation(DELETE, 'channel', target=target))
+
+        if reorder:
+            self.channels.append(Operation(REORDER, 'channel', changes={'positions': reorder}))
+
+    # applying
+
+    def _role_ref(self, refs, role_id):
+        if role_id in refs:
+            return refs[role_id]
+
+        role = self.role_map.get(role_id)
+        if role is not None:
+            return role['id']
+
+        if role_id == self.source_guild['id']:
+            return self.target_guild['id']
+
+        # Overwrites of members keep their id
+        return role_id
+
+    def _channel_ref(self, refs, channel_id):
+        if channel_id is None:
+            return None
+
+        if channel_id in refs:
+            return refs[channel_id]
+
+        channel = self.channel_map.get(channel_id)
+        return channel['id'] if channel is not None else None
+
+    def apply(self, executor, *, reason=None):
+        """
+        Adds all operations to a RestoreExecutor
+
+        Created roles and channels are referenced by Refs, so overwrites and parents of new objects are
+        resolved while the executor runs. Returns the ids of the mutations that were added.
+        """
+        guild_id = self.target_guild['id']
+        refs = {}
+        added = []
+
+        def _add(id, func, *args, **kwargs):
+            added.append(id)
+            return executor.add(id, func, *args, reason=reason, **kwargs)
+
+        def _overwrites(overwrites):
+            result = []
+            for o in overwrites:
+                if o['type'] in (0, 'role') and o['id'] not in refs and o['id'] not in self.role_map \
+                        and o['id'] != self.source_guild['id']:
+                    # The role doesn't exist anymore
+                    continue
+
+                result.append({**o, 'id': self._role_ref(refs, o['id'])})
+
+            return result
+
+        for op in self.roles:
+            if op.kind == CREATE:
+                if op.source['id'] == self.source_guild['id']:
+                    continue
+
+                refs[op.source['id']] = _add(('role', op.source['id']), 'create_role', guild_id, **op.changes)
+            elif op.kind == UPDATE:
+                _add(('role', op.source['id']), 'edit_role', guild_id, op.target['id'], **op.changes)
+            elif op.kind == DELETE:
+                _add(('delete_role', op.target['id']), 'delete_role', guild_id, op.target['id'])
+            elif op.kind == REORDER:
+                positions = [
+                    {'id': refs[s['id']] if t is None else t['id'], 'position': position}
+                    for s, t, position in op.changes['positions']
+                    if t is not None or s['id'] in refs
+                ]
+                _add(('role', 'positions'), 'move_role_position', guild_id, positions)
+
+        # Parents are created before their channels because the Ref adds a dependency
+        for op in sorted(self.channels, key=lambda o: o.source is None or o.source['type'] != CATEGORY):
+            if op.kind == CREATE:
+                changes = dict(op.changes)
+                changes['parent_id'] = self._channel_ref(refs, changes.get('parent_id'))
+                changes['permission_overwrites'] = _overwrites(changes['permission_overwrites'])
+                refs[op.source['id']] = _add(('channel', op.source['id']), 'create_channel', guild_id, **changes)
+            elif op.kind == UPDATE:
+                changes = dict(op.changes)
+                if 'parent_id' in changes:
+                    changes['parent_id'] = self._channel_ref(refs, changes['parent_id'])
+                if 'permission_overwrites' in changes:
+                    changes['permission_overwrites'] = _overwrites(changes['permission_overwrites'])
+
+                _add(('channel', op.source['id']), 'edit_channel', op.target['id'], **changes)
+            elif op.kind == DELETE:
+                _add(('delete_channel', op.target['id']), 'delete_channel', op.target['id'])
+            elif op.kind == REORDER:
+                positions = [
+                    {'id': refs[s['id']] if t is None else t['id'], 'position': position}
+                    for s, t, position in op.changes['positions']
+                    if t is not None or s['id'] in refs
+                ]
+                # Parents of moved channels have to be updated first
+                after = [('channel', s['id']) for s, t, _ in op.changes['positions']
+                         if t is not None and ('channel', s['id']) in executor.nodes]
+                _add(('channel', 'positions'), 'bulk_channel_update', guild_id, positions, after=after)
+
+        return added
+
+
+def diff_guild(snapshot, live):
+    """
+    Compares a snapshot of a guild (a Guild entity with roles and channels) with the live guild
+    """
+    source, target = _data(snapshot), _data(live)
+    result = GuildDiff(source, target)
+    result._diff_roles(source.get('roles', []), target.get('roles', []))
+    result._diff_channels(source.get('channels', []), target.get('channels', []))
+    return result
@@ -36,11 +36,14 @@ class HTTPException(DiscordException):
         The status code of the HTTP request.
     code: :class:`int`
         The Discord specific error code for the failure.
+    data: Union[:class:`dict`, :class:`str`]
+        The parsed body of the response.
     """
 
     def __init__(self, response, message):
         self.response = response
         self.status = response.status
+        self.data = message
         if isinstance(message, dict):
             self.code = message.get('code', 0)
             base = message.get('message', '')
@@ -78,6 +81,33 @@ class NotFound(HTTPException):
     pass
 
 
+class CircuitOpen(DiscordException):
+    """Exception that's thrown when a request is not sent because the circuit breaker of
+    its route is open after too many failures.
+
+    Attributes
+    ------------
+    route: :class:`str`
+        The label of the route (method and path).
+    retry_after: :class:`float`
+        Seconds until the circuit breaker lets a probe request through again.
+    """
+
+    def __init__(self, route, retry_after):
+        self.route = route
+        self.retry_after = retry_after
+        super().__init__('Circuit for {0} is open, retry in {1:.2f} seconds'.format(route, retry_after))
+
+
+class DeadlineExceeded(DiscordException):
+    """Exception that's thrown when a request is dropped because the deadline of
+    the scope it was made in (e.g. a command) has passed before it could be sent."""
+
+    def __init__(self, route):
+        self.route = route
+        super().__init__('Deadline for {0} has passed before the request could be sent'.format(route))
+
+
 class GatewayNotFound(Exception):
     """An exception that is usually thrown when the gateway hub
     for the :class:`Client` websocket is not found."""
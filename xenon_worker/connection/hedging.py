@@ -0,0 +1,63 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Hedger:
+    """
+    Opt-in request hedging for latency critical, idempotent GET requests
+
+    If a request hasn't answered after the hedge delay of its route (counted from when it was sent), a second
+    copy is sent and whichever response arrives first wins. Hedges are only sent if the rate limit bucket of
+    the route has requests left. The delay is either fixed per route or the p95 latency of the route
+    (once at least `min_samples` requests have been observed). Every request deposits `ratio` hedge tokens
+    (up to `burst`) and every hedge withdraws one, so at most about `ratio` of all requests are hedged.
+    """
+
+    def __init__(self, metrics, *, percentile=0.95, min_samples=100, ratio=0.05, burst=10):
+        self.metrics = metrics
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.ratio = ratio
+        self.burst = burst
+        self.routes = {}
+
+        self._tokens = float(burst)
+
+    def enable(self, method, path, delay=None):
+        """
+        Enables hedging for a GET route
+
+        If delay is None, the p95 latency of the route is used.
+        """
+        if method != 'GET':
+            raise ValueError('Only idempotent GET requests can be hedged')
+
+        self.routes['%s:%s' % (method, path)] = delay
+
+    def disable(self, method, path):
+        self.routes.pop('%s:%s' % (method, path), None)
+
+    def enabled(self, route):
+        return route.label in self.routes
+
+    def delay_for(self, route):
+        delay = self.routes.get(route.label)
+        if delay is not None:
+            return delay
+
+        hist = self.metrics.histogram("latency", route.label)
+        if hist is None or hist.count < self.min_samples:
+            return None
+
+        return hist.percentile(self.percentile)
+
+    def deposit(self):
+        self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def withdraw(self):
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
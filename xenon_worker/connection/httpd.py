@@ -5,43 +5,92 @@ from . import utils
 import sys
 import os.path
 import io
+import mmap as _mmap
 import weakref
 import time
+import copy
 
 import aiohttp
 
-from .errors import HTTPException, Forbidden, NotFound, LoginFailure, GatewayNotFound
+from .errors import HTTPException, Forbidden, NotFound, LoginFailure, GatewayNotFound, DeadlineExceeded
 from .utils import json_or_text
+from .metrics import Metrics
+from .ratelimits import BucketRegistry, GlobalLimiter, InvalidRequestGuard
+from .scheduler import RequestScheduler, AdaptiveConcurrency, current_key, current_priority, time_left, \
+    without_deadline
+from .cache import ResponseCache
+from .pools import ConnectionPools
+from .retry import RetryEngine, CircuitBreakers
+from .hedging import Hedger
+from .tracing import RequestTracer
+from .planner import RequestPlanner
+from .cdn import CDNCache, CDNFetcher
+from .coalesce import MutationCoalescer
 
 log = logging.getLogger(__name__)
 
 
-class File:
-    __slots__ = ('fp', 'filename', '_original_pos', '_owner', '_closer')
+# Size of the chunks that streamed file contents are sent in
+CHUNK_SIZE = 2 ** 16
+
+
+async def _iter_chunks(view):
+    for i in range(0, len(view), CHUNK_SIZE):
+        yield view[i:i + CHUNK_SIZE]
 
-    def __init__(self, fp, filename=None, *, spoiler=False):
+
+class File:
+    """
+    A file that is uploaded with a message
+
+    `fp` can be
+    - a path, the file is streamed from disk and opened again for every attempt
+      (or memory mapped if `mmap` is set)
+    - a seekable and readable file object, it's streamed and rewound for every attempt
+    - a mmap.mmap, bytes or bytearray, sent in chunks without copying it
+    - a callable that returns an async iterable of bytes, called again for every attempt
+    - an async iterable of bytes, which can only be sent once, so the upload isn't retried
+    """
+    __slots__ = ('fp', 'filename', '_original_pos', '_owner', '_closer', '_path', '_mmap', '_handle', '_consumed')
+
+    def __init__(self, fp, filename=None, *, spoiler=False, mmap=False):
         self.fp = fp
+        self._original_pos = 0
+        self._owner = False
+        self._closer = None
+        self._path = None
+        self._mmap = None
+        self._handle = None
+        self._consumed = False
 
         if isinstance(fp, io.IOBase):
             if not (fp.seekable() and fp.readable()):
                 raise ValueError('File buffer {!r} must be seekable and readable'.format(fp))
-            self.fp = fp
             self._original_pos = fp.tell()
-            self._owner = False
-        else:
-            self.fp = open(fp, 'rb')
-            self._original_pos = 0
-            self._owner = True
 
-        # aiohttp only uses two methods from IOBase
-        # read and close, since I want to control when the files
-        # close, I need to stub it so it doesn't close unless
-        # I tell it to
-        self._closer = self.fp.close
-        self.fp.close = lambda: None
+            # aiohttp only uses two methods from IOBase
+            # read and close, since I want to control when the files
+            # close, I need to stub it so it doesn't close unless
+            # I tell it to
+            self._closer = fp.close
+            fp.close = lambda: None
+
+        elif isinstance(fp, (str, os.PathLike)):
+            self._path = fp
+            if mmap:
+                with open(fp, 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    # Empty files can't be mapped
+                    self._mmap = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ) if size else b''
+
+                self._owner = True
+
+        elif not isinstance(fp, (_mmap.mmap, bytes, bytearray)) and not callable(fp) \
+                and not hasattr(fp, '__aiter__'):
+            raise TypeError('Unsupported file type {!r}'.format(type(fp)))
 
         if filename is None:
-            if isinstance(fp, str):
+            if isinstance(fp, (str, os.PathLike)):
                 _, self.filename = os.path.split(fp)
             else:
                 self.filename = getattr(fp, 'name', None)
@@ -51,6 +100,42 @@ class File:
         if spoiler and self.filename is not None and not self.filename.startswith('SPOILER_'):
             self.filename = 'SPOILER_' + self.filename
 
+    @property
+    def replayable(self):
+        """
+        Whether the file can be sent again after it was sent once
+        """
+        return not hasattr(self.fp, '__aiter__')
+
+    def open(self):
+        """
+        Returns the value that is sent for this file in the current attempt
+        """
+        self.reset()
+        fp = self.fp
+        if self._mmap is not None:
+            return _iter_chunks(memoryview(self._mmap))
+
+        elif self._path is not None:
+            # aiohttp closes the handle after the body was written
+            self._handle = open(self._path, 'rb')
+            return self._handle
+
+        elif isinstance(fp, io.IOBase):
+            return fp
+
+        elif isinstance(fp, (_mmap.mmap, bytes, bytearray)):
+            return _iter_chunks(memoryview(fp))
+
+        elif hasattr(fp, '__aiter__'):
+            if self._consumed:
+                raise RuntimeError('File stream {!r} has already been consumed'.format(fp))
+
+            self._consumed = True
+            return fp
+
+        return fp()
+
     def reset(self, *, seek=True):
         # The `seek` parameter is needed because
         # the retry-loop is iterated over multiple times
@@ -60,40 +145,104 @@ class File:
         # is 0, and thus false, then this prevents an
         # unnecessary seek since it's the first request
         # done.
-        if seek:
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+        if seek and self._closer is not None:
             self.fp.seek(self._original_pos)
 
     def close(self):
-        self.fp.close = self._closer
-        if self._owner:
-            self._closer()
+        self.reset(seek=False)
+        if self._closer is not None:
+            self.fp.close = self._closer
+
+        if self._owner and isinstance(self._mmap, _mmap.mmap):
+            self._mmap.close()
+
+
+def _form_data(form):
+    """
+    Builds the multipart body of a request, files are opened again for every attempt
+    """
+    data = aiohttp.FormData()
+    for params in form:
+        value = params['value']
+        if isinstance(value, File):
+            params = dict(params, value=value.open())
+
+        data.add_field(**params)
+
+    return data
+
+
+class RouteTemplate:
+    """
+    The parts of a route that only depend on method and path
+
+    Templates are compiled once per endpoint and shared by all routes of that endpoint.
+    """
+    __slots__ = ('method', 'path', 'url', 'label', 'has_parameters')
+
+    def __init__(self, method, path, base):
+        self.method = method
+        self.path = path
+        self.url = base + path
+        self.label = method + ':' + path
+        self.has_parameters = '{' in path
 
 
 class Route:
+    __slots__ = ('template', 'method', 'path', 'url', 'parameters', 'channel_id', 'guild_id', 'webhook_id',
+                 'bucket')
+
     BASE = 'https://discord.com/api/v8'
+    _templates = {}
 
     def __init__(self, method, path, **parameters):
+        template = self.template = self.compile(method, path)
         self.path = path
         self.method = method
-        url = (self.BASE + self.path)
-        if parameters:
-            self.url = url.format(**{k: _uriquote(v) if isinstance(v, str) else v for k, v in parameters.items()})
+        if parameters and template.has_parameters:
+            self.url = template.url.format(**{
+                k: _uriquote(v) if isinstance(v, str) else v for k, v in parameters.items()
+            })
         else:
-            self.url = url
+            self.url = template.url
+
+        self.parameters = parameters
 
         # major parameters:
         self.channel_id = parameters.get('channel_id')
         self.guild_id = parameters.get('guild_id')
         self.webhook_id = parameters.get('webhook_id')
 
-    @property
-    def bucket(self):
         # the bucket is just method + path w/ major parameters
         if self.webhook_id is not None:
-            return '{0.channel_id}:{0.guild_id}:{0.webhook_id}:{0.path}'.format(self)
+            self.bucket = '{0.channel_id}:{0.guild_id}:{0.webhook_id}:{0.path}'.format(self)
 
         else:
-            return '{0.channel_id}:{0.guild_id}:{0.path}'.format(self)
+            self.bucket = '{0.channel_id}:{0.guild_id}:{0.path}'.format(self)
+
+    @classmethod
+    def set_base(cls, base):
+        """
+        Points all routes to another api base url, e.g. a mock server
+        """
+        cls.BASE = base
+        cls._templates.clear()
+
+    @classmethod
+    def compile(cls, method, path):
+        try:
+            return cls._templates[(method, path)]
+        except KeyError:
+            template = cls._templates[(method, path)] = RouteTemplate(method, path, cls.BASE)
+            return template
+
+    @property
+    def label(self):
+        return self.template.label
 
 
 class HTTPClient:
@@ -102,26 +251,204 @@ class HTTPClient:
     SUCCESS_LOG = '{method} {url} has received {text}'
     REQUEST_LOG = '{method} {url} with {json} has returned {status}'
 
-    def __init__(self, connector=None, *, proxy=None, proxy_auth=None, loop=None, unsync_clock=True):
+    def __init__(self, connector=None, *, proxy=None, proxy_auth=None, loop=None, unsync_clock=True,
+                 global_rate=50, concurrency=50, min_concurrency=5, max_concurrency=200, cache_ttls=None,
+                 json_backends=None, trace_requests=True, cdn_cache=None, cdn_cache_size=2 ** 30,
+                 cdn_concurrency=10, coalesce_window=0.005):
         self.loop = asyncio.get_event_loop() if loop is None else loop
         self.connector = connector
+        self.metrics = Metrics(loop=self.loop)
+        self.tracer = RequestTracer(self.metrics, enabled=trace_requests)
+        self.pools = ConnectionPools(api_connector=connector, trace_configs=[self.tracer.trace_config],
+                                     loop=self.loop)
         self.__session = None  # filled in static_login
         self.proxy = proxy
         self.proxy_auth = proxy_auth
         self.use_clock = not unsync_clock
         self.token = None
         self.redis = None
+        self.metrics.add_collector(self.pools.collect)
+        if json_backends:
+            utils.use_json_backend(*json_backends)
 
         self.global_over = asyncio.Event()
         self.global_over.set()
         self.ratelimits = weakref.WeakValueDictionary()
-        self.semaphore = asyncio.Semaphore(value=50)
+        self._inflight = {}
+        self.cache = ResponseCache()
+        for (method, path), ttl in (cache_ttls or {}).items():
+            self.cache.enable(method, path, ttl)
+
+        self.buckets = BucketRegistry()
+        self.retries = RetryEngine(metrics=self.metrics)
+        self.circuits = CircuitBreakers()
+        self.hedger = Hedger(self.metrics)
+        self.metrics.add_collector(self.circuits.collect)
+        self.global_limiter = GlobalLimiter(rate=global_rate, loop=self.loop)
+        self.invalid_guard = InvalidRequestGuard(loop=self.loop)
+        self.metrics.add_collector(self.invalid_guard.collect)
+        # More slots than connections would only make requests wait in the connector while holding their bucket
+        pool_size = connector.limit if connector is not None else self.pools.api_limit
+        if pool_size:
+            max_concurrency = min(max_concurrency, pool_size)
+            concurrency = min(concurrency, max_concurrency)
+
+        self.scheduler = RequestScheduler(concurrency, metrics=self.metrics, loop=self.loop)
+        self.concurrency = AdaptiveConcurrency(
+            self.scheduler,
+            min_limit=min_concurrency,
+            max_limit=max_concurrency,
+            metrics=self.metrics
+        )
+        self.planner = RequestPlanner(self.buckets, self.global_limiter, self.scheduler, self.metrics)
+        self.cdn = CDNFetcher(
+            self.pools,
+            CDNCache(cdn_cache, max_size=cdn_cache_size, loop=self.loop) if cdn_cache is not None else None,
+            concurrency=cdn_concurrency,
+            metrics=self.metrics,
+            loop=self.loop
+        )
+        self.mutations = MutationCoalescer(self, window=coalesce_window, metrics=self.metrics, loop=self.loop)
 
         user_agent = 'DiscordBot (https://github.com/Magic-Bots/xenon-worker) Python/{0[0]}.{0[1]} aiohttp/{1}'
         self.user_agent = user_agent.format(sys.version_info, aiohttp.__version__)
 
-    async def request(self, route, *, files=None, **kwargs):
-        bucket = route.bucket
+    async def use_redis(self, redis):
+        self.redis = redis
+        self.metrics.start(redis)
+        self.global_limiter.redis = redis
+        self.invalid_guard.start(redis)
+        self.cache.redis = redis
+        self.retries.budget.redis = redis
+        await self.buckets.load(redis)
+
+    @staticmethod
+    def _coalesce_key(route, kwargs):
+        if route.method != 'GET' or set(kwargs.keys()) - {'params', 'priority'}:
+            return None
+
+        params = kwargs.get('params')
+        return route.url, tuple(sorted(params.items())) if params else None
+
+    async def _wait_inflight(self, route, task):
+        # Every caller waits for the shared request with its own deadline
+        left = time_left()
+        if left is None:
+            return await asyncio.shield(task)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), max(left, 0))
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(route.label)
+
+    async def request(self, route, *, files=None, coalesce=True, **kwargs):
+        # Identical GET requests that are in-flight at the same time are only sent once
+        key = self._coalesce_key(route, kwargs) if coalesce and not files else None
+        if key is None:
+            return await self._request(route, files=files, **kwargs)
+
+        cached = self.cache.ttl_for(route) is not None
+        if cached:
+            data = await self.cache.get(route, key)
+            if data is not None:
+                self.metrics.incr("requests:cached", route.label)
+                return data
+
+        # Requests are only shared between callers of the same priority
+        inflight_key = key + (kwargs.get('priority', current_priority()),)
+        # Entities might modify the data, every caller (including the first) gets its own copy
+        task = self._inflight.get(inflight_key)
+        if task is not None:
+            self.metrics.incr("requests:coalesced", route.label)
+            return copy.deepcopy(await self._wait_inflight(route, task))
+
+        # The request runs in its own task so cancelling one caller doesn't affect the others
+        if self.hedger.enabled(route):
+            coro = self._hedged_request(route, kwargs)
+        else:
+            coro = self._request(route, **kwargs)
+
+        # The deadline of the first caller doesn't apply to the others
+        task = self._inflight[inflight_key] = self.loop.create_task(without_deadline(coro))
+        task.add_done_callback(lambda t: self._inflight_done(inflight_key, t))
+        data = await self._wait_inflight(route, task)
+        if cached:
+            await self.cache.set(route, key, data)
+
+        return copy.deepcopy(data)
+
+    async def _hedged_request(self, route, kwargs):
+        self.hedger.deposit()
+        sent = asyncio.Event()
+        first = self.loop.create_task(self._request(route, sent=sent, **dict(kwargs)))
+        delay = self.hedger.delay_for(route)
+        if delay is None:
+            return await first
+
+        # Time spent waiting for rate limits and a slot isn't slow network, only hedge once the request is sent
+        waiter = self.loop.create_task(sent.wait())
+        try:
+            await asyncio.wait({first, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+
+        if first.done():
+            return first.result()
+
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not self.hedger.withdraw():
+            return await first
+
+        # The hedge doesn't wait for the local bucket lock that is held by the first request,
+        # instead it has to take one of the requests that are left in the bucket
+        if not await self.buckets.try_acquire(self.buckets.resolve(route)):
+            return await first
+
+        self.metrics.incr("requests:hedged", route.label)
+        second = self.loop.create_task(self._request(route, hedge=True, **dict(kwargs)))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.metrics.incr("requests:hedged:won", route.label)
+
+                        return task.result()
+
+            # Both failed
+            return first.result()
+        finally:
+            for task in (first, second):
+                if not task.done():
+                    task.cancel()
+
+    async def plan(self, routes, *, dry_run=False):
+        """
+        Estimates how long it takes to make a request to each of the routes and which buckets limit that
+
+        With dry_run the current bucket state is ignored and only the recorded limits are used.
+        Returns a :class:`Plan`.
+        """
+        return await self.planner.plan(routes, dry_run=dry_run)
+
+    def _inflight_done(self, key, task):
+        self._inflight.pop(key, None)
+        # Mark the exception as retrieved, in case all callers were cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def _check_deadline(self, route):
+        left = time_left()
+        if left is not None and left <= 0:
+            self.metrics.incr("requests:expired", route.label)
+            raise DeadlineExceeded(route.label)
+
+        return left
+
+    async def _request(self, route, *, files=None, form=None, priority=None, hedge=False, sent=None, **kwargs):
+        bucket = self.buckets.resolve(route)
         method = route.method
         url = route.url
 
@@ -134,7 +461,7 @@ class HTTPClient:
         # some checking if it's a JSON request
         if 'json' in kwargs:
             headers['Content-Type'] = 'application/json'
-            kwargs['data'] = utils.to_json(kwargs.pop('json'))
+            kwargs['data'] = utils.to_json_bytes(kwargs.pop('json'))
 
         try:
             reason = kwargs.pop('reason')
@@ -144,6 +471,8 @@ class HTTPClient:
             if reason:
                 headers['X-Audit-Log-Reason'] = _uriquote(reason, safe='/ ')
 
+        # extra headers, e.g. the content type of a raw body forwarded by the proxy
+        headers.update(kwargs.pop('headers', None) or {})
         kwargs['headers'] = headers
 
         # Proxy support
@@ -152,44 +481,122 @@ class HTTPClient:
         if self.proxy_auth is not None:
             kwargs['proxy_auth'] = self.proxy_auth
 
-        if route.bucket in self.ratelimits:
-            lock = self.ratelimits[route.bucket]
+        # requests are queued fairly between guilds, unless the caller specified something else
+        fair_key = current_key() or route.guild_id or route.channel_id or route.webhook_id
+
+        if hedge:
+            lock = asyncio.Lock()
+
+        elif bucket in self.ratelimits:
+            lock = self.ratelimits[bucket]
 
         else:
-            lock = self.ratelimits[route.bucket] = asyncio.Lock()
+            lock = self.ratelimits[bucket] = asyncio.Lock()
+
+        policy = self.retries.policy_for(route)
+        breaker = self.circuits.get(route)
+        backoff = None
+        r = data = error = None
 
         # Check if bucket ratelimit was hit and acquire the lock
-        for tries in range(5):
-            if files:
-                for f in files:
-                    f.reset(seek=tries)
+        for tries in range(policy.tries):
+            # Back off before we take the bucket lock and a slot again
+            if backoff:
+                await asyncio.sleep(backoff)
+                backoff = None
 
-            if not self.global_over.is_set():
-                await self.global_over.wait()
+            # Fail fast if the route is currently failing anyways
+            breaker.before()
 
-            await lock.acquire()
-            unlock = True
+            # Streams that can only be read once can't be sent again
+            if tries and files and not all(f.replayable for f in files):
+                log.warning('Not retrying %s %s, the uploaded files can only be sent once', method, url)
+                break
 
-            await self.semaphore.acquire()
-            await self.redis.set(f"requests:running", 50 - self.semaphore._value)
-            await self.redis.set(f"requests:waiting", len(self.semaphore._waiters))
+            timings = self.tracer.timings()
 
+            # Slow down or stop before we get banned by cloudflare for too many invalid requests
+            await self.invalid_guard.acquire()
+            timings.mark('guard')
+
+            # The bucket lock queues all requests of the bucket, nobody should wait there past the deadline
+            left = self._check_deadline(route)
             try:
-                await self.redis.hincrby(f"requests", f"{route.method}:{route.path}", 1)
-                async with self.__session.request(method, url, **kwargs) as r:
-                    await self.redis.hincrby(f"responses", str(r.status), 1)
+                await asyncio.wait_for(lock.acquire(), left)
+            except asyncio.TimeoutError:
+                self.metrics.incr("requests:expired", route.label)
+                raise DeadlineExceeded(route.label)
+
+            unlock = True
+            scheduled = False
+            status = None
+            # Everything after this point has to release the bucket lock, also if it's cancelled
+            try:
+                timings.mark('bucket_lock')
+
+                # Wait for the bucket to have capacity across all workers, hedges already took a request
+                self._check_deadline(route)
+                if not hedge:
+                    await self.buckets.acquire(route, bucket)
+                timings.mark('bucket')
+
+                # The global token is only taken right before sending, requests that wait for their bucket
+                # would otherwise all be sent at once without a token when the bucket resets
+                if not self.global_over.is_set():
+                    await self.global_over.wait()
+
+                self._check_deadline(route)
+                await self.global_limiter.acquire()
+                timings.mark('global')
+
+                left = self._check_deadline(route)
+                try:
+                    await asyncio.wait_for(self.scheduler.acquire(priority, fair_key), left)
+                except asyncio.TimeoutError:
+                    self.metrics.incr("requests:expired", route.label)
+                    raise DeadlineExceeded(route.label)
+
+                scheduled = True
+                timings.mark('scheduler')
+
+                # The multipart body is built for every attempt, so files are streamed again from the start
+                if form is not None:
+                    kwargs['data'] = _form_data(form)
+
+                self.metrics.incr("requests", route.label)
+                if sent is not None:
+                    sent.set()
+
+                start = time.perf_counter()
+                async with self.__session.request(method, url, trace_request_ctx=timings, **kwargs) as r:
+                    status = r.status
+                    latency = time.perf_counter() - start
+                    self.metrics.observe("latency", route.label, latency)
+                    self.concurrency.sample(latency, r.status)
+                    self.metrics.incr("responses", str(r.status))
+                    self.invalid_guard.record(r)
                     log.debug('%s %s with %s has returned %s', method, url, kwargs.get('data'), r.status)
 
                     # even errors have text involved in them so this is safe to call
                     data = await json_or_text(r)
+                    timings.mark('body')
+
+                    if r.status != 429:
+                        self.buckets.update(route, r, use_clock=self.use_clock)
+
+                    if r.status >= 500:
+                        breaker.failure()
+                    else:
+                        breaker.success()
 
                     # the request was successful so just return the text/json
                     if 300 > r.status >= 200:
                         log.debug('%s %s has received %s', method, url, data)
+                        self.retries.success()
 
                         remaining = r.headers.get('X-Ratelimit-Remaining')
                         if remaining == "0":
-                            delta = utils._parse_ratelimit_header(r, use_clock=False)
+                            delta = utils._parse_ratelimit_header(r, use_clock=self.use_clock)
                             log.info('A rate limit bucket has been exhausted (bucket: %s, retry: %s).', bucket,
                                         delta)
                             self.loop.call_later(delta, lock.release)
@@ -209,13 +616,16 @@ class HTTPClient:
                         # check if it's a global rate limit
                         is_global = data.get('global', False)
                         if is_global:
-                            await self.redis.hincrby(f"responses:429", f"global", 1)
+                            self.metrics.incr("responses:429", "global")
+                            self.concurrency.sample(overload=True)
                             log.warning('Global rate limit has been hit. Retrying in %.2f seconds.', retry_after)
                             self.global_over.clear()
                             self.loop.call_later(retry_after, self.global_over.set)
+                            await self.global_limiter.block(retry_after)
 
                         else:
-                            await self.redis.hincrby(f"responses:429", f"{route.method}:{route.path}", 1)
+                            self.metrics.incr("responses:429", route.label)
+                            self.buckets.exhaust(route, retry_after, bucket)
                             log.warning(
                                 'We are being rate limited. Retrying in %.2f seconds. Handled under the bucket "%s"',
                                 retry_after, bucket
@@ -225,10 +635,13 @@ class HTTPClient:
 
                         continue
 
-                    # we've received a 500 or 502, unconditional retry
-                    elif r.status in {500, 502}:
-                        await asyncio.sleep(1 + tries * 2)
-                        continue
+                    # server errors are retried depending on the retry policy of the route
+                    elif r.status >= 500:
+                        backoff = await self.retries.retry(route, policy, tries, status=r.status)
+                        if backoff is not None:
+                            log.warning('%s %s has returned %s. Retrying in %.2f seconds.',
+                                        method, url, r.status, backoff)
+                            continue
 
                     # the usual error cases
                     if r.status == 403:
@@ -237,32 +650,49 @@ class HTTPClient:
                         raise NotFound(r, data)
                     else:
                         raise HTTPException(r, data)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.concurrency.sample(overload=True)
+                breaker.failure()
+                backoff = await self.retries.retry(route, policy, tries, error=e)
+                if backoff is None:
+                    raise
+
+                log.warning('%s %s has failed (%s). Retrying in %.2f seconds.',
+                            method, url, e.__class__.__name__, backoff)
+                error = e
+                continue
             finally:
-                self.semaphore.release()
-                await self.redis.set(f"requests:running", 50 - self.semaphore._value)
-                await self.redis.set(f"requests:waiting", len(self.semaphore._waiters))
+                if scheduled:
+                    self.scheduler.release()
+                self.tracer.record(route, timings, status)
                 if unlock and lock.locked():
                     lock.release()
 
         # We've run out of retries, raise.
+        if r is None:
+            raise error
+
         raise HTTPException(r, data)
 
-    async def get_from_cdn(self, url):
-        async with self.__session.get(url) as resp:
-            if resp.status == 200:
-                return await resp.read()
-            elif resp.status == 404:
-                raise NotFound(resp, 'asset not found')
-            elif resp.status == 403:
-                raise Forbidden(resp, 'cannot retrieve asset')
-            else:
-                raise HTTPException(resp, 'failed to get asset')
+    def get_from_cdn(self, url):
+        return self.cdn.read(url)
+
+    def open_from_cdn(self, url):
+        """
+        Returns a read-only memory map of the asset if the cdn cache is enabled, the content otherwise
+
+        Both can be uploaded again with :class:`File` without copying them.
+        """
+        return self.cdn.open(url)
+
+    def stream_from_cdn(self, url, chunk_size=2 ** 16):
+        return self.cdn.stream(url, chunk_size)
 
     # state management
 
     async def close(self):
-        if self.__session:
-            await self.__session.close()
+        await self.metrics.close()
+        await self.pools.close()
 
     def _token(self, token, *, bot=True):
         self.token = token
@@ -271,10 +701,13 @@ class HTTPClient:
 
     # login management
 
-    async def static_login(self, token=False, *, bot=True):
+    async def static_login(self, token=False, *, bot=True, warmup=True):
         # Necessary to get aiohttp to stop complaining about session creation
-        self.__session = aiohttp.ClientSession(connector=self.connector)
+        self.pools.open()
+        self.__session = self.pools.api
         self._token(token, bot=bot)
+        if warmup:
+            await self.pools.warmup(api_base=Route.BASE)
 
         try:
             data = await self.request(Route('GET', '/users/@me'))
@@ -354,10 +787,21 @@ class HTTPClient:
     def send_typing(self, channel_id):
         return self.request(Route('POST', '/channels/{channel_id}/typing', channel_id=channel_id))
 
+    @staticmethod
+    def _files_form(payload, files):
+        form = [{'name': 'payload_json', 'value': utils.to_json(payload)}]
+        if len(files) == 1:
+            form.append({'name': 'file', 'value': files[0], 'filename': files[0].filename,
+                         'content_type': 'application/octet-stream'})
+        else:
+            for index, file in enumerate(files):
+                form.append({'name': 'file%s' % index, 'value': file, 'filename': file.filename,
+                             'content_type': 'application/octet-stream'})
+
+        return form
+
     def send_files(self, channel_id, *, files, content=None, tts=False, embed=None, nonce=None):
         r = Route('POST', '/channels/{channel_id}/messages', channel_id=channel_id)
-        form = aiohttp.FormData()
-
         payload = {'tts': tts}
         if content:
             payload['content'] = content
@@ -366,16 +810,7 @@ class HTTPClient:
         if nonce:
             payload['nonce'] = nonce
 
-        form.add_field('payload_json', utils.to_json(payload))
-        if len(files) == 1:
-            file = files[0]
-            form.add_field('file', file.fp, filename=file.filename, content_type='application/octet-stream')
-        else:
-            for index, file in enumerate(files):
-                form.add_field('file%s' % index, file.fp, filename=file.filename,
-                               content_type='application/octet-stream')
-
-        return self.request(r, data=form, files=files)
+        return self.request(r, form=self._files_form(payload, files), files=files)
 
     async def ack_message(self, channel_id, message_id):
         r = Route('POST', '/channels/{channel_id}/messages/{message_id}/ack', channel_id=channel_id,
@@ -629,19 +1064,8 @@ class HTTPClient:
 
         files = options.get("files", [])
         if len(files) > 0:
-            form = aiohttp.FormData()
-            form.add_field("payload_json", utils.to_json(payload))
-
-            if len(files) == 1:
-                file = files[0]
-                form.add_field('file', file.fp, filename=file.filename, content_type='application/octet-stream')
-
-            else:
-                for index, file in enumerate(files):
-                    form.add_field('file%s' % index, file.fp, filename=file.filename,
-                                   content_type='application/octet-stream')
-
-            return self.request(r, data=form, files=files, params={"wait": 'true' if wait else 'false'})
+            return self.request(r, form=self._files_form(payload, files), files=files,
+                                params={"wait": 'true' if wait else 'false'})
 
         else:
             return self.request(r, json=payload, params={"wait": 'true' if wait else 'false'})
@@ -696,8 +1120,14 @@ class HTTPClient:
 
         return self.request(Route('PATCH', '/guilds/{guild_id}', guild_id=guild_id), json=payload, reason=reason)
 
-    def get_bans(self, guild_id):
-        return self.request(Route('GET', '/guilds/{guild_id}/bans', guild_id=guild_id))
+    def get_bans(self, guild_id, limit=None, after=None):
+        params = {}
+        if limit:
+            params['limit'] = limit
+        if after:
+            params['after'] = after
+
+        return self.request(Route('GET', '/guilds/{guild_id}/bans', guild_id=guild_id), params=params or None)
 
     def get_ban(self, user_id, guild_id):
         return self.request(Route('GET', '/guilds/{guild_id}/bans/{user_id}', guild_id=guild_id, user_id=user_id))
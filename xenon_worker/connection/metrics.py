@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import time
+import bisect
+import traceback
+
+log = logging.getLogger(__name__)
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    DEFAULT_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, bounds=None):
+        self.bounds = tuple(bounds or self.DEFAULT_BOUNDS)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def percentile(self, p):
+        """
+        Rough percentile estimate, returns the upper bound of the bucket that contains the p-th percentile
+        """
+        if self.count == 0:
+            return None
+
+        target = self.count * p
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+
+        return self.bounds[-1]
+
+    def fields(self):
+        fields = {}
+        for bound, c in zip(self.bounds, self.counts):
+            if c:
+                fields['le:%s' % bound] = c
+
+        if self.counts[-1]:
+            fields['le:inf'] = self.counts[-1]
+
+        fields['count'] = self.count
+        return fields
+
+
+class Metrics:
+    """
+    In-process metrics aggregator.
+
+    All recording methods only touch local memory, so they are safe to call from hot paths.
+    A background task periodically flushes everything that was recorded since the last flush
+    to redis in a single pipeline. If redis is slow or unavailable, flushing is suspended for
+    a while (circuit breaker) and the pending data is kept until the next successful flush.
+    """
+
+    def __init__(self, redis=None, *, interval=5, timeout=2, failure_threshold=3, cooldown=30, loop=None):
+        self.redis = redis
+        self.loop = loop or asyncio.get_event_loop()
+        self.interval = interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._local_histograms = {}
+        self._collectors = []
+
+        self._failures = 0
+        self._open_until = 0
+        self._task = None
+
+    # recording
+
+    def incr(self, key, field, value=1):
+        fields = self._counters.get(key)
+        if fields is None:
+            fields = self._counters[key] = {}
+
+        fields[field] = fields.get(field, 0) + value
+
+    def gauge(self, key, value):
+        self._gauges[key] = value
+
+    def observe(self, key, field, value, bounds=None):
+        """
+        Records the value in the histogram that gets flushed and in a local one that is never reset
+        """
+        for histograms in (self._histograms, self._local_histograms):
+            hist = histograms.get((key, field))
+            if hist is None:
+                hist = histograms[(key, field)] = Histogram(bounds)
+
+            hist.observe(value)
+
+    def histogram(self, key, field):
+        """
+        Returns the local histogram for key and field that includes all values since the process started
+        """
+        return self._local_histograms.get((key, field))
+
+    def histograms(self, key):
+        """
+        Returns all local histograms of key as {field: histogram}
+        """
+        return {f: hist for (k, f), hist in self._local_histograms.items() if k == key}
+
+    def add_collector(self, collector):
+        """
+        Registers a callable that is called with this instance before every flush to record gauges
+        that are cheaper to sample periodically than to track on every change
+        """
+        self._collectors.append(collector)
+
+    # flushing
+
+    @property
+    def circuit_open(self):
+        return self._open_until > time.monotonic()
+
+    def _swap(self):
+        counters, gauges, histograms = self._counters, self._gauges, self._histograms
+        self._counters, self._gauges, self._histograms = {}, {}, {}
+        return counters, gauges, histograms
+
+    def _restore(self, counters, gauges, histograms):
+        for key, fields in counters.items():
+            for field, value in fields.items():
+                self.incr(key, field, value)
+
+        for key, value in gauges.items():
+            self._gauges.setdefault(key, value)
+
+        for (key, field), hist in histograms.items():
+            current = self._histograms.get((key, field))
+            if current is None:
+                self._histograms[(key, field)] = hist
+                continue
+
+            for i, c in enumerate(hist.counts):
+                current.counts[i] += c
+
+            current.sum += hist.sum
+            current.count += hist.count
+
+    async def flush(self):
+        if self.redis is None or self.circuit_open:
+            return
+
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception:
+                traceback.print_exc()
+
+        counters, gauges, histograms = self._swap()
+        if not (counters or gauges or histograms):
+            return
+
+        tr = self.redis.pipeline()
+        for key, fields in counters.items():
+            for field, value in fields.items():
+                tr.hincrby(key, field, value)
+
+        for key, value in gauges.items():
+            tr.set(key, value)
+
+        for (key, field), hist in histograms.items():
+            hkey = '%s:%s' % (key, field)
+            for bucket, value in hist.fields().items():
+                tr.hincrby(hkey, bucket, value)
+
+            tr.hincrbyfloat(hkey, 'sum', hist.sum)
+
+        try:
+            await asyncio.wait_for(tr.execute(), timeout=self.timeout)
+        except Exception as e:
+            self._restore(counters, gauges, histograms)
+            self._failures += 1
+            log.warning('Failed to flush metrics (%s: %s)', e.__class__.__name__, e)
+            if self._failures >= self.failure_threshold:
+                log.warning('Suspending metrics flushing for %s seconds', self.cooldown)
+                self._open_until = time.monotonic() + self.cooldown
+                self._failures = 0
+
+        else:
+            self._failures = 0
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def start(self, redis=None):
+        if redis is not None:
+            self.redis = redis
+
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        await self.flush()
@@ -3,6 +3,9 @@ import msgpack
 from .httpd import Route
 import asyncio
 from .errors import *
+from .snapshot import SnapshotBuilder
+from .restore import RestoreExecutor
+from . import diff
 
 
 class MemberIterator:
@@ -202,10 +205,32 @@ class HttpMixin:
         raise NotFound  # Keep it consistent
 
     async def fetch_full_guild(self, guild_id):
-        result = await self.http.get_guild(guild_id)
-        result["channels"] = await self.http.get_guild_channels(guild_id)
+        result, channels = await asyncio.gather(
+            self.http.get_guild(guild_id),
+            self.http.get_guild_channels(guild_id)
+        )
+        result["channels"] = channels
         return Guild(result)
 
+    def snapshot_guild(self, guild_id, **kwargs):
+        """
+        Fetches the guild, channels, webhooks, members and bans concurrently. See SnapshotBuilder
+        """
+        return SnapshotBuilder(self, guild_id, **kwargs).build()
+
+    def restore_executor(self, **kwargs):
+        """
+        Returns a RestoreExecutor that runs dependent mutations through this client
+        """
+        return RestoreExecutor(self.http, **kwargs)
+
+    async def diff_guild(self, snapshot, guild_id):
+        """
+        Compares a snapshot of a guild (Guild or GuildSnapshot) with the live state of guild_id
+        """
+        live = await self.fetch_full_guild(guild_id)
+        return diff.diff_guild(getattr(snapshot, 'guild', snapshot), live)
+
     async def fetch_guild(self, guild_id):
         result = await self.http.get_guild(guild_id)
         return Guild(result)
@@ -256,6 +281,17 @@ class HttpMixin:
         result = await self.http.create_channel(guild.id, *args, **kwargs)
         return Channel(result)
 
+    async def edit_channel(self, channel, **kwargs):
+        """
+        Edits of the same channel and position changes in the same guild within a few milliseconds are
+        merged into one request. See MutationCoalescer
+        """
+        result = await self.http.mutations.edit_channel(channel.id, guild_id=channel.guild_id, **kwargs)
+        return Channel(result) if isinstance(result, dict) else None
+
+    async def move_channel(self, channel, position, **kwargs):
+        return await self.http.mutations.move_channel(channel.guild_id, channel.id, position, **kwargs)
+
     async def delete_channel(self, channel, *args, **kwargs):
         return await self.http.delete_channel(channel.id, *args, **kwargs)
 
@@ -263,8 +299,12 @@ class HttpMixin:
         result = await self.http.create_role(guild.id, *args, **kwargs)
         return Role(result)
 
-    async def edit_role(self, role, *args, **kwargs):
-        result = await self.http.edit_role(role.guild_id, role.id, *args, **kwargs)
+    async def edit_role(self, role, **kwargs):
+        result = await self.http.mutations.edit_role(role.guild_id, role.id, **kwargs)
+        return Role(result)
+
+    async def move_role(self, role, position, **kwargs):
+        result = await self.http.mutations.move_role(role.guild_id, role.id, position, **kwargs)
         return Role(result)
 
     async def delete_role(self, role, *args, **kwargs):
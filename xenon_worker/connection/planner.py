@@ -0,0 +1,238 @@
+import heapq
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class BucketPlan:
+    """
+    Simulated schedule of all planned requests of one rate limit bucket
+
+    `finish` is the time in seconds after which the last request of the bucket is expected to be done.
+    It's split up into time spent waiting for the bucket to reset (`bucket_wait`), waiting for the global
+    limit or a concurrency slot (`global_wait`) and the requests themselves (`busy`).
+    """
+    __slots__ = ('bucket', 'label', 'requests', 'limit', 'per', 'known', 'finish', 'bucket_wait', 'global_wait',
+                 'busy')
+
+    def __init__(self, bucket, label, limit, per, known):
+        self.bucket = bucket
+        self.label = label
+        self.limit = limit
+        self.per = per
+        self.known = known
+        self.requests = 0
+        self.finish = 0
+        self.bucket_wait = 0
+        self.global_wait = 0
+        self.busy = 0
+
+    def __repr__(self):
+        return '<BucketPlan label={0.label!r} requests={0.requests} limit={0.limit}/{0.per}s ' \
+               'finish={0.finish:.2f}>'.format(self)
+
+
+class Plan:
+    """
+    Result of HTTPClient.plan
+
+    `buckets` is sorted by finish time, the first one is the critical path that determines the duration.
+    `finish_times` has the expected finish time of every planned route in the order they were passed.
+    """
+
+    def __init__(self, duration, buckets, finish_times, dry_run=False):
+        self.duration = duration
+        self.buckets = buckets
+        self.finish_times = finish_times
+        self.dry_run = dry_run
+
+        self._sorted_times = sorted(finish_times)
+
+    @property
+    def critical(self):
+        return self.buckets[0] if self.buckets else None
+
+    def progress(self, elapsed):
+        """
+        Returns the fraction of requests that are expected to be done after elapsed seconds
+        """
+        if not self._sorted_times:
+            return 1
+
+        done = 0
+        for finish in self._sorted_times:
+            if finish > elapsed:
+                break
+
+            done += 1
+
+        return done / len(self._sorted_times)
+
+    def __repr__(self):
+        return '<Plan requests={0} duration={1.duration:.2f} critical={1.critical!r}>'.format(
+            len(self.finish_times), self
+        )
+
+
+class _BucketState:
+    __slots__ = ('routes', 'plan', 'remaining', 'reset')
+
+    def __init__(self, plan, remaining, reset):
+        self.routes = []
+        self.plan = plan
+        self.remaining = remaining
+        self.reset = reset
+
+
+class RequestPlanner:
+    """
+    Estimates how long a batch of requests will take under the current rate limits
+
+    Requests of the same bucket are sent one after another (like HTTPClient does), each bucket allows `limit`
+    requests per `per` seconds as recorded by the BucketRegistry, all requests share the global limit and the
+    concurrency limit of the scheduler and every request takes the mean observed latency of its route.
+    Unless `dry_run` is set, the current state of the buckets and the global limit is read from redis.
+    Buckets we haven't seen yet are assumed to allow `default_limit` requests per `default_per` seconds.
+    """
+
+    def __init__(self, buckets, global_limiter, scheduler, metrics, *, default_limit=5, default_per=5,
+                 default_latency=0.25):
+        self.buckets = buckets
+        self.global_limiter = global_limiter
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.default_limit = default_limit
+        self.default_per = default_per
+        self.default_latency = default_latency
+
+    def _latency(self, route):
+        hist = self.metrics.histogram("latency", route.label)
+        if hist is None or hist.count == 0:
+            return self.default_latency
+
+        return hist.sum / hist.count
+
+    async def _current_state(self, keys):
+        """
+        Returns the remaining requests and seconds until the reset of every bucket and how long the global
+        limit is blocked for
+        """
+        redis = self.buckets.redis
+        if redis is None:
+            return {}, 0
+
+        try:
+            tr = redis.pipeline()
+            tr.time()
+            for key in keys:
+                tr.hmget('%s:%s' % (self.buckets.prefix, key), 'remaining', 'reset')
+
+            tr.pttl('%s:global:blocked' % self.global_limiter.prefix)
+            now, *states, blocked = await tr.execute()
+        except Exception as e:
+            log.warning('Failed to load rate limit state (%s: %s)', e.__class__.__name__, e)
+            return {}, 0
+
+        result = {}
+        for key, (remaining, reset) in zip(keys, states):
+            if remaining is None or reset is None:
+                continue
+
+            reset_after = int(reset) / 1000 - now
+            if reset_after > 0:
+                result[key] = (int(remaining), reset_after)
+
+        return result, max(blocked, 0) / 1000
+
+    async def plan(self, routes, *, dry_run=False):
+        states = {}
+        order = []
+        for index, route in enumerate(routes):
+            key = self.buckets.resolve(route)
+            state = states.get(key)
+            if state is None:
+                limits = self.buckets.limit_for(route)
+                limit, per = limits or (self.default_limit, self.default_per)
+                state = states[key] = _BucketState(
+                    BucketPlan(key, route.label, limit, per, limits is not None),
+                    limit, None
+                )
+
+            state.routes.append((index, route))
+            order.append(key)
+
+        blocked = 0
+        if not dry_run:
+            current, blocked = await self._current_state(list(states.keys()))
+            for key, (remaining, reset_after) in current.items():
+                states[key].remaining = remaining
+                states[key].reset = reset_after
+
+        # The same token bucket the GlobalLimiter uses
+        capacity = self.global_limiter.burst
+        rate = self.global_limiter.refill
+        tokens = float(capacity)
+        tokens_ts = blocked
+        concurrency = max(self.scheduler.limit, 1)
+        inflight = []
+        finish_times = [0] * len(order)
+
+        # (time the next request of the bucket can be sent, sequence, bucket key, position in the bucket)
+        ready = []
+        for seq, key in enumerate(states.keys()):
+            heapq.heappush(ready, (blocked, seq, key, 0))
+
+        while ready:
+            t, seq, key, position = heapq.heappop(ready)
+            state = states[key]
+            plan = state.plan
+            index, route = state.routes[position]
+
+            # Wait for the bucket to reset if it's exhausted
+            if state.reset is not None and t >= state.reset:
+                state.remaining, state.reset = plan.limit, None
+
+            if state.remaining <= 0:
+                plan.bucket_wait += state.reset - t
+                t = state.reset
+                state.remaining, state.reset = plan.limit, None
+
+            # Wait for a token of the global limit and a concurrency slot
+            before = t
+            tokens = min(capacity, tokens + max(t - tokens_ts, 0) * rate)
+            tokens_ts = max(tokens_ts, t)
+            if tokens < 1:
+                t = max(t, tokens_ts) + (1 - tokens) / rate
+                tokens, tokens_ts = 1, t
+
+            tokens -= 1
+            while inflight and inflight[0] <= t:
+                heapq.heappop(inflight)
+
+            if len(inflight) >= concurrency:
+                t = max(t, heapq.heappop(inflight))
+
+            plan.global_wait += t - before
+
+            # The window of a bucket starts with its first request
+            if state.reset is not None and t >= state.reset:
+                state.remaining, state.reset = plan.limit, None
+
+            if state.reset is None:
+                state.reset = t + plan.per
+
+            state.remaining -= 1
+
+            latency = self._latency(route)
+            finish = t + latency
+            heapq.heappush(inflight, finish)
+            finish_times[index] = finish
+            plan.requests += 1
+            plan.busy += latency
+            plan.finish = finish
+
+            if position + 1 < len(state.routes):
+                heapq.heappush(ready, (finish, seq, key, position + 1))
+
+        buckets = sorted((s.plan for s in states.values()), key=lambda p: p.finish, reverse=True)
+        return Plan(max(finish_times, default=0), buckets, finish_times, dry_run=dry_run)
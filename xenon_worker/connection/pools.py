@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionPools:
+    """
+    Owns the aiohttp sessions of a client
+
+    API requests and CDN downloads use separate, tuned connection pools so large asset downloads can't take
+    connections away from API requests. Both pools cache DNS lookups and keep idle connections alive
+    for a while so they can be reused.
+    """
+
+    API_BASE = 'https://discord.com/api/v8'
+    CDN_URL = 'https://cdn.discordapp.com'
+
+    def __init__(self, *, api_limit=100, cdn_limit=20, keepalive_timeout=60, ttl_dns_cache=300,
+                 api_connector=None, trace_configs=None, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.api_limit = api_limit
+        self.cdn_limit = cdn_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self._api_connector = api_connector
+        self._trace_configs = trace_configs
+
+        self.api = None
+        self.cdn = None
+
+    def _connector(self, limit):
+        return aiohttp.TCPConnector(
+            limit=limit,
+            ttl_dns_cache=self.ttl_dns_cache,
+            keepalive_timeout=self.keepalive_timeout,
+            enable_cleanup_closed=True,
+            loop=self.loop
+        )
+
+    def open(self):
+        if self.api is None or self.api.closed:
+            connector = self._api_connector or self._connector(self.api_limit)
+            self.api = aiohttp.ClientSession(connector=connector, trace_configs=self._trace_configs, loop=self.loop)
+
+        if self.cdn is None or self.cdn.closed:
+            self.cdn = aiohttp.ClientSession(connector=self._connector(self.cdn_limit), loop=self.loop)
+
+    async def _warmup(self, session, url, count):
+        async def _connect():
+            try:
+                async with session.head(url) as resp:
+                    await resp.release()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.debug('Failed to warm up connection to %s (%s: %s)', url, e.__class__.__name__, e)
+
+        await asyncio.gather(*[_connect() for _ in range(count)])
+
+    async def warmup(self, api=10, cdn=2, *, api_base=None):
+        """
+        Opens connections in advance, so the first requests don't have to wait for the TCP and TLS handshakes
+
+        api_base is the base url the api requests are sent to (Route.BASE).
+        """
+        self.open()
+        api_url = (api_base or self.API_BASE) + '/gateway'
+        await asyncio.gather(
+            self._warmup(self.api, api_url, min(api, self.api_limit or api)),
+            self._warmup(self.cdn, self.CDN_URL, min(cdn, self.cdn_limit or cdn))
+        )
+
+    @staticmethod
+    def _stats(session):
+        connector = session.connector
+        if connector is None or session.closed:
+            return 0, 0, 0
+
+        acquired = len(getattr(connector, '_acquired', ()))
+        idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+        waiting = sum(len(waiters) for waiters in getattr(connector, '_waiters', {}).values())
+        return acquired, idle, waiting
+
+    def collect(self, metrics):
+        for name, session, limit in (('api', self.api, self.api_limit), ('cdn', self.cdn, self.cdn_limit)):
+            if session is None:
+                continue
+
+            acquired, idle, waiting = self._stats(session)
+            metrics.gauge('pools:%s:acquired' % name, acquired)
+            metrics.gauge('pools:%s:idle' % name, idle)
+            metrics.gauge('pools:%s:waiting' % name, waiting)
+            if limit:
+                metrics.gauge('pools:%s:saturation' % name, round(acquired / limit, 2))
+
+    async def close(self):
+        for session in (self.api, self.cdn):
+            if session is not None and not session.closed:
+                await session.close()
@@ -0,0 +1,256 @@
+"""
+Optional proxy mode
+
+A single ProxyServer process owns the connection pool and all rate limiting (buckets, global limit, retries,
+circuit breakers, ...) for the whole fleet. Workers use a ProxyHTTPClient which has the same interface as
+HTTPClient, but forwards every request to the proxy over HTTP or a unix socket.
+
+Start the proxy with ``python -m xenon_worker.connection.proxy``, it's configured through the environment
+variables TOKEN, REDIS_URL, REDIS_DB, PROXY_HOST, PROXY_PORT, PROXY_PATH (unix socket) and PROXY_SECRET.
+Every request has to carry the shared secret in the X-Proxy-Secret header. A proxy without a secret only
+accepts connections on localhost or a unix socket.
+"""
+
+import asyncio
+import hmac
+import inspect
+import logging
+import os
+import re
+from urllib.parse import quote as _uriquote
+
+import aiohttp
+import aioredis
+from aiohttp import web
+
+from . import httpd, mixins, utils
+from .errors import HTTPException, Forbidden, NotFound, CircuitOpen, DeadlineExceeded
+from .httpd import HTTPClient, Route, _form_data
+from .scheduler import request_scope, current_priority, current_key, time_left
+from .utils import json_or_text
+
+log = logging.getLogger(__name__)
+
+# Headers that are passed through from the worker to discord
+_FORWARDED_HEADERS = ('Content-Type', 'X-Audit-Log-Reason')
+
+_LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+_ROUTE_PATTERN = re.compile(r"Route\(\s*'([A-Z]+)',\s*'([^']+)'")
+
+
+def known_routes():
+    """
+    Returns the (method, path) of every route the clients can make
+    """
+    routes = set()
+    for module in (httpd, mixins):
+        routes.update(_ROUTE_PATTERN.findall(inspect.getsource(module)))
+
+    return frozenset(routes)
+
+
+class ProxyHTTPClient(HTTPClient):
+    """
+    HTTPClient that sends all requests through a ProxyServer
+
+    Rate limiting, retries and connection pooling happen in the proxy, this client only forwards the
+    route, body, priority and deadline of each request.
+    """
+
+    def __init__(self, url='http://127.0.0.1:9000', *, path=None, secret=None, loop=None, **kwargs):
+        connector = aiohttp.UnixConnector(path=path, loop=loop) if path is not None else None
+        super().__init__(connector, loop=loop, **kwargs)
+        self.proxy_url = url.rstrip('/') + '/request'
+        self.secret = secret
+
+    async def static_login(self, token=False, *, bot=True, warmup=False):
+        return await super().static_login(token, bot=bot, warmup=warmup)
+
+    async def _request(self, route, *, files=None, form=None, priority=None, hedge=False, sent=None, **kwargs):
+        headers = {
+            'X-Route-Method': route.method,
+            'X-Route-Path': route.path,
+            'X-Route-Parameters': utils.to_json(route.parameters),
+            'X-Route-Url': route.url,
+            'X-Request-Priority': str(int(current_priority() if priority is None else priority))
+        }
+        if self.secret is not None:
+            headers['X-Proxy-Secret'] = self.secret
+
+        key = current_key()
+        if key is not None:
+            headers['X-Request-Key'] = key
+
+        left = time_left()
+        if left is not None:
+            if left <= 0:
+                raise DeadlineExceeded(route.label)
+
+            headers['X-Request-Timeout'] = str(left)
+
+        if 'json' in kwargs:
+            headers['Content-Type'] = 'application/json'
+            kwargs['data'] = utils.to_json_bytes(kwargs.pop('json'))
+
+        reason = kwargs.pop('reason', None)
+        if reason:
+            headers['X-Audit-Log-Reason'] = _uriquote(reason, safe='/ ')
+
+        if form is not None:
+            kwargs['data'] = _form_data(form)
+
+        if sent is not None:
+            sent.set()
+
+        # The proxy retries with the raw body, so we don't have to
+        async with self.pools.api.post(self.proxy_url, headers=headers, **kwargs) as r:
+            data = await json_or_text(r)
+            error = r.headers.get('X-Proxy-Error')
+            if error == 'CircuitOpen':
+                raise CircuitOpen(route.label, float(r.headers.get('Retry-After', 0)))
+            elif error == 'DeadlineExceeded':
+                raise DeadlineExceeded(route.label)
+
+            if 300 > r.status >= 200:
+                return data
+
+            if r.status == 403:
+                raise Forbidden(r, data)
+            elif r.status == 404:
+                raise NotFound(r, data)
+            else:
+                raise HTTPException(r, data)
+
+
+class ProxyServer:
+    def __init__(self, token, *, host='127.0.0.1', port=9000, path=None, secret=None, routes=None, redis_url=None,
+                 redis_db=0, loop=None, **http_options):
+        if secret is None and path is None and host not in _LOCAL_HOSTS:
+            raise ValueError('A proxy that is reachable from other hosts needs a secret')
+
+        self.loop = loop or asyncio.get_event_loop()
+        self.token = token
+        self.secret = secret
+        # Only routes of the client are forwarded, anything else could be any request in the name of the bot
+        self.routes = known_routes() | frozenset(routes or ())
+        self.host = host
+        self.port = port
+        self.path = path
+        self.redis_url = redis_url
+        self.redis_db = redis_db
+
+        self.http = HTTPClient(loop=self.loop, **http_options)
+        self.app = web.Application()
+        self.app.router.add_post('/request', self.handle)
+        self.runner = None
+
+    @staticmethod
+    def _response(status, data, headers=None):
+        if isinstance(data, (dict, list)):
+            return web.Response(status=status, body=utils.to_json_bytes(data), content_type='application/json',
+                                headers=headers)
+
+        return web.Response(status=status, text=data or '', headers=headers)
+
+    async def handle(self, request):
+        if self.secret is not None:
+            secret = request.headers.get('X-Proxy-Secret', '')
+            if not hmac.compare_digest(secret.encode(), self.secret.encode()):
+                return self._response(401, '', {'X-Proxy-Error': 'Unauthorized'})
+
+        method, path = request.headers.get('X-Route-Method'), request.headers.get('X-Route-Path')
+        if (method, path) not in self.routes:
+            return self._response(400, '', {'X-Proxy-Error': 'UnknownRoute'})
+
+        try:
+            parameters = utils.from_json(request.headers.get('X-Route-Parameters') or '{}')
+            # Every placeholder of the path has to be filled
+            path.format(**parameters)
+            route = Route(method, path, **parameters)
+        except (ValueError, TypeError, KeyError, IndexError):
+            return self._response(400, '', {'X-Proxy-Error': 'InvalidParameters'})
+
+        # Some routes add query parameters to the url (e.g. the audit log reason of kicks and bans)
+        url = request.headers.get('X-Route-Url')
+        if url is not None and url.startswith(Route.BASE + '/'):
+            route.url = url
+
+        kwargs = {}
+        if request.query:
+            kwargs['params'] = dict(request.query)
+
+        headers = {h: request.headers[h] for h in _FORWARDED_HEADERS if h in request.headers}
+        if headers:
+            kwargs['headers'] = headers
+
+        body = await request.read()
+        if body:
+            kwargs['data'] = body
+
+        timeout = request.headers.get('X-Request-Timeout')
+        try:
+            with request_scope(
+                    priority=int(request.headers.get('X-Request-Priority', 1)),
+                    key=request.headers.get('X-Request-Key'),
+                    timeout=float(timeout) if timeout is not None else None
+            ):
+                data = await self.http.request(route, **kwargs)
+
+        except CircuitOpen as e:
+            return self._response(503, '', {'X-Proxy-Error': 'CircuitOpen', 'Retry-After': str(e.retry_after)})
+
+        except DeadlineExceeded:
+            return self._response(504, '', {'X-Proxy-Error': 'DeadlineExceeded'})
+
+        except HTTPException as e:
+            return self._response(e.status, e.data)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning('Failed to forward %s %s (%s: %s)', route.method, route.url, e.__class__.__name__, e)
+            return self._response(502, str(e))
+
+        return self._response(200, data)
+
+    async def start(self):
+        if self.redis_url is not None:
+            redis = await aioredis.create_redis_pool(self.redis_url)
+            await redis.select(self.redis_db)
+            await self.http.use_redis(redis)
+
+        await self.http.static_login(self.token)
+
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        if self.path is not None:
+            site = web.UnixSite(self.runner, self.path)
+        else:
+            site = web.TCPSite(self.runner, self.host, self.port)
+
+        await site.start()
+        log.info('Proxy is listening on %s', self.path or '%s:%s' % (self.host, self.port))
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+        await self.http.close()
+
+    def run(self):
+        self.loop.create_task(self.start())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.close())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    ProxyServer(
+        os.environ['TOKEN'],
+        host=os.environ.get('PROXY_HOST', '127.0.0.1'),
+        port=int(os.environ.get('PROXY_PORT', 9000)),
+        path=os.environ.get('PROXY_PATH'),
+        secret=os.environ.get('PROXY_SECRET'),
+        redis_url=os.environ.get('REDIS_URL'),
+        redis_db=int(os.environ.get('REDIS_DB', 0))
+    ).run()
@@ -4,9 +4,9 @@ import asyncio
 import traceback
 from motor.motor_asyncio import AsyncIOMotorClient
 import aioredis
-import aiohttp
 
 from .httpd import HTTPClient
+from .proxy import ProxyHTTPClient
 from .entities import User
 from .mixins import HttpMixin, CacheMixin
 
@@ -21,7 +21,8 @@ class Event:
 
 
 class RabbitClient(CacheMixin, HttpMixin):
-    def __init__(self, rabbit_url, mongo_url, redis_url, redis_db, loop=None):
+    def __init__(self, rabbit_url, mongo_url, redis_url, redis_db, loop=None, http_proxy=None, cdn_cache=None,
+                 http_proxy_secret=None):
         super().__init__()
         self.url = rabbit_url
         self.user = None
@@ -37,7 +38,14 @@ class RabbitClient(CacheMixin, HttpMixin):
         self.static_subscriptions = set()
         self.session = None
 
-        self.http = HTTPClient(loop=loop)
+        if http_proxy is None:
+            self.http = HTTPClient(loop=loop, cdn_cache=cdn_cache)
+
+        elif http_proxy.startswith("unix:"):
+            self.http = ProxyHTTPClient(path=http_proxy[5:], secret=http_proxy_secret, loop=loop, cdn_cache=cdn_cache)
+
+        else:
+            self.http = ProxyHTTPClient(http_proxy, secret=http_proxy_secret, loop=loop, cdn_cache=cdn_cache)
         self.mongo = AsyncIOMotorClient(host=mongo_url)
 
     def _process_listeners(self, event, *args, **kwargs):
@@ -86,10 +94,34 @@ class RabbitClient(CacheMixin, HttpMixin):
     def has_listener(self, key):
         return len(self.listeners.get(key, [])) > 0
 
+    def _invalidate_cache(self, event, data):
+        cache = self.http.cache
+        # The response cache is opt-in, most workers don't cache anything
+        if not cache.ttls or not isinstance(data, dict):
+            return
+
+        def _invalidate(**parameters):
+            if all(cache.caches(k) for k in parameters):
+                self.loop.create_task(cache.invalidate(**parameters))
+
+        if event in ("channel_create", "channel_update", "channel_delete"):
+            _invalidate(channel_id=data.get("id"))
+            _invalidate(guild_id=data.get("guild_id"))
+
+        elif event in ("guild_update", "guild_delete"):
+            _invalidate(guild_id=data.get("id"))
+
+        elif event in ("guild_role_create", "guild_role_update", "guild_role_delete", "guild_emojis_update"):
+            _invalidate(guild_id=data.get("guild_id"))
+
+        elif event in ("guild_member_update", "guild_member_remove"):
+            _invalidate(guild_id=data.get("guild_id"), member_id=data.get("user", {}).get("id"))
+
     async def _message_received(self, msg):
         payload = msgpack.unpackb(msg.body)
         shard_id, event, data = payload["shard_id"], payload["event"], payload["data"]
         ev = event.lower()
+        self._invalidate_cache(ev, data)
         self._process_listeners(Event(ev, shard_id), data)
         self._dispatch(Event(ev, shard_id), data)
 
@@ -143,12 +175,14 @@ class RabbitClient(CacheMixin, HttpMixin):
 
     async def start(self, token, shared_queue, *shared_subs):
         try:
-            self.session = aiohttp.ClientSession(loop=self.loop)
-            self.http.redis = self.redis = await aioredis.create_redis_pool(self.redis_url)
+            self.redis = await aioredis.create_redis_pool(self.redis_url)
             await self.redis.select(self.redis_db)
+            await self.http.use_redis(self.redis)
 
             user_data = await self.http.static_login(token)
             self.user = User(user_data)
+            # Shares the connection pool of the cdn with the http client
+            self.session = self.http.pools.cdn
 
             self.connection = await aiormq.connect(self.url)
             self.channel = await self.connection.channel()
@@ -0,0 +1,601 @@
+import asyncio
+import logging
+import time
+import traceback
+
+from aioredis.errors import ReplyError
+
+from . import utils
+
+log = logging.getLogger(__name__)
+
+
+class LuaScript:
+    """
+    Small wrapper around a lua script that uses EVALSHA and (re-)loads the script if redis doesn't know it yet
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.sha = None
+
+    async def __call__(self, redis, keys=(), args=()):
+        if self.sha is not None:
+            try:
+                return await redis.evalsha(self.sha, keys=list(keys), args=list(args))
+            except ReplyError as e:
+                if not str(e).startswith('NOSCRIPT'):
+                    raise
+
+        self.sha = await redis.script_load(self.source)
+        return await redis.evalsha(self.sha, keys=list(keys), args=list(args))
+
+
+# Lua helper that returns the redis server time in milliseconds.
+# Using the redis clock makes the shared state independent of clock drift between the workers.
+_NOW = """
+redis.replicate_commands()
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+"""
+
+# KEYS[1] bucket state
+# Returns 0 if a request can be made or the number of ms to wait otherwise
+_ACQUIRE = LuaScript(_NOW + """
+local state = redis.call('HMGET', KEYS[1], 'remaining', 'reset')
+local remaining = tonumber(state[1])
+local reset = tonumber(state[2])
+if remaining == nil or reset == nil then
+    return 0
+end
+
+if reset <= now then
+    redis.call('HDEL', KEYS[1], 'remaining', 'reset')
+    return 0
+end
+
+if remaining > 0 then
+    redis.call('HINCRBY', KEYS[1], 'remaining', -1)
+    return 0
+end
+
+return reset - now
+""")
+
+# KEYS[1] bucket state
+# ARGV[1] limit, ARGV[2] remaining, ARGV[3] reset after in ms
+_UPDATE = LuaScript(_NOW + """
+local limit = tonumber(ARGV[1])
+local remaining = tonumber(ARGV[2])
+local reset = now + tonumber(ARGV[3])
+
+local state = redis.call('HMGET', KEYS[1], 'remaining', 'reset')
+local c_remaining = tonumber(state[1])
+local c_reset = tonumber(state[2])
+
+-- Only apply the new state if it belongs to a new window or is more restrictive than the current one
+if c_remaining == nil or c_reset == nil or c_reset <= now or reset > c_reset + 1000 or remaining < c_remaining then
+    redis.call('HSET', KEYS[1], 'remaining', remaining, 'reset', reset)
+end
+
+-- A negative limit means that the limit is unknown (e.g. after a 429)
+if limit >= 0 then
+    redis.call('HSET', KEYS[1], 'limit', limit)
+end
+
+redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[3]) + 60000)
+return 0
+""")
+
+
+class RedisBreaker:
+    """
+    Keeps a slow or unavailable redis from holding requests hostage
+
+    Every call gives up after `timeout` seconds. After `failure_threshold` failed calls in a row, `open`
+    is True for `cooldown` seconds and the callers are expected to fall back to their local state.
+    """
+
+    def __init__(self, name, *, timeout=0.05, failure_threshold=3, cooldown=10):
+        self.name = name
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self._failures = 0
+        self._open_until = 0
+
+    @property
+    def open(self):
+        return self._open_until > time.monotonic()
+
+    async def call(self, coro):
+        try:
+            result = await asyncio.wait_for(coro, timeout=self.timeout)
+        except Exception:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                log.warning('Suspending %s for %s seconds', self.name, self.cooldown)
+                self._open_until = time.monotonic() + self.cooldown
+                self._failures = 0
+
+            raise
+
+        self._failures = 0
+        return result
+
+
+class BucketRegistry:
+    """
+    Maps routes to the rate limit buckets discord reports in the X-RateLimit-Bucket header
+    and shares the state of each bucket between all workers through redis.
+
+    Without redis only the route -> bucket mapping is tracked.
+    The limit and window length of every bucket are recorded in `limits` for the planner.
+
+    Every redis call gives up after `timeout` seconds. After `failure_threshold` failed calls in a row, redis
+    is skipped for `cooldown` seconds and requests are only limited by the local state. The state reported by
+    responses is written to redis in the background, so nothing waits for it while holding the bucket.
+    """
+
+    def __init__(self, redis=None, *, prefix='ratelimits', timeout=0.05, failure_threshold=3, cooldown=10):
+        self.redis = redis
+        self.prefix = prefix
+        self.hashes = {}
+        self.limits = {}
+        self.breaker = RedisBreaker('shared rate limits', timeout=timeout, failure_threshold=failure_threshold,
+                                    cooldown=cooldown)
+
+        # bucket -> [remaining, reset (monotonic)] as reported by the last response
+        self._local = {}
+
+    @property
+    def circuit_open(self):
+        return self.breaker.open
+
+    def _shared(self):
+        return self.redis is not None and not self.breaker.open
+
+    def _call(self, coro):
+        return self.breaker.call(coro)
+
+    async def _write(self, coro, action):
+        try:
+            await self._call(coro)
+        except Exception as e:
+            log.warning('Failed to %s (%s: %s)', action, e.__class__.__name__, e)
+
+    def _spawn(self, coro, action):
+        asyncio.ensure_future(self._write(coro, action))
+
+    def _set_local(self, bucket, remaining, reset_after):
+        now = time.monotonic()
+        if len(self._local) > 10000:
+            self._local = {k: v for k, v in self._local.items() if v[1] > now}
+
+        self._local[bucket] = [remaining, now + reset_after]
+
+    async def load(self, redis=None):
+        if redis is not None:
+            self.redis = redis
+
+        if self.redis is None:
+            return
+
+        try:
+            hashes = await self.redis.hgetall('%s:buckets' % self.prefix, encoding='utf-8')
+            limits = await self.redis.hgetall('%s:limits' % self.prefix, encoding='utf-8')
+        except Exception as e:
+            log.warning('Failed to load rate limit buckets (%s: %s)', e.__class__.__name__, e)
+        else:
+            self.hashes.update(hashes)
+            for key, value in limits.items():
+                limit, per = value.split(':')
+                self.limits.setdefault(key, (int(limit), float(per)))
+
+    def resolve(self, route):
+        """
+        Returns the key of the bucket that the route belongs to
+
+        Falls back to the guessed bucket of the route if discord hasn't told us the bucket yet.
+        """
+        bucket_hash = self.hashes.get(route.label)
+        if bucket_hash is None:
+            return route.bucket
+
+        return '%s:%s:%s:%s' % (bucket_hash, route.channel_id, route.guild_id, route.webhook_id)
+
+    def limit_for(self, route):
+        """
+        Returns the recorded (limit, per) of the bucket of a route or None if it's unknown
+        """
+        return self.limits.get(self.hashes.get(route.label, route.label))
+
+    def _record_limit(self, key, limit, remaining, reset_after):
+        # The first request of a window tells us the exact window length, later ones only a lower bound
+        known = self.limits.get(key)
+        if remaining == limit - 1 or known is None:
+            per = reset_after
+        else:
+            per = max(known[1], reset_after)
+
+        per = round(per, 3)
+        if known is not None and known[0] == limit and abs(known[1] - per) <= known[1] * 0.1:
+            return
+
+        self.limits[key] = (limit, per)
+        if self._shared():
+            self._spawn(self.redis.hset('%s:limits' % self.prefix, key, '%s:%s' % (limit, per)), 'store rate limit')
+
+    def take(self, bucket):
+        """
+        Takes a request from the local state of the bucket
+
+        Returns False if the last response said that there are no requests left or the state is unknown.
+        """
+        state = self._local.get(bucket)
+        if state is not None and state[0] > 0 and state[1] > time.monotonic():
+            state[0] -= 1
+            return True
+
+        return False
+
+    async def acquire(self, route, bucket=None):
+        bucket = bucket or self.resolve(route)
+        # The local state is only a guess for this worker, the shared state decides if redis is used
+        self.take(bucket)
+        while self._shared():
+            try:
+                wait = await self._call(_ACQUIRE(self.redis, keys=('%s:%s' % (self.prefix, bucket),)))
+            except Exception as e:
+                # A broken redis should never stop us from making requests
+                log.warning('Failed to acquire rate limit bucket %s (%s: %s)', bucket, e.__class__.__name__, e)
+                return
+
+            if wait <= 0:
+                return
+
+            log.debug('Rate limit bucket %s is exhausted cluster wide, waiting %sms', bucket, wait)
+            await asyncio.sleep(wait / 1000)
+
+    async def try_acquire(self, bucket):
+        """
+        Takes a request from the bucket without waiting, returns False if none are known to be left
+        """
+        if not self.take(bucket):
+            return False
+
+        if not self._shared():
+            return True
+
+        try:
+            wait = await self._call(_ACQUIRE(self.redis, keys=('%s:%s' % (self.prefix, bucket),)))
+        except Exception as e:
+            log.warning('Failed to acquire rate limit bucket %s (%s: %s)', bucket, e.__class__.__name__, e)
+            return True
+
+        return wait <= 0
+
+    def update(self, route, response, *, use_clock=False):
+        """
+        Records the bucket hash and the rate limit state from the headers of a response
+
+        Returns the bucket key the route is handled under after the update.
+        """
+        headers = response.headers
+        key = route.label
+        bucket_hash = headers.get('X-RateLimit-Bucket')
+        if bucket_hash is not None and self.hashes.get(key) != bucket_hash:
+            self.hashes[key] = bucket_hash
+            if self._shared():
+                self._spawn(self.redis.hset('%s:buckets' % self.prefix, key, bucket_hash), 'store rate limit bucket')
+
+        bucket = self.resolve(route)
+        limit = headers.get('X-RateLimit-Limit')
+        remaining = headers.get('X-RateLimit-Remaining')
+        if limit is None or remaining is None:
+            return bucket
+
+        try:
+            limit, remaining = int(limit), int(remaining)
+            reset_after = max(utils._parse_ratelimit_header(response, use_clock=use_clock), 0)
+        except (KeyError, ValueError) as e:
+            log.warning('Failed to parse rate limit headers (%s: %s)', e.__class__.__name__, e)
+            return bucket
+
+        self._set_local(bucket, remaining, reset_after)
+        self._record_limit(self.hashes.get(key, key), limit, remaining, reset_after)
+        if self._shared():
+            # The update script only applies states that are newer or more restrictive, so the order doesn't matter
+            self._spawn(_UPDATE(
+                self.redis,
+                keys=('%s:%s' % (self.prefix, bucket),),
+                args=(limit, remaining, int(reset_after * 1000))
+            ), 'update rate limit bucket %s' % bucket)
+
+        return bucket
+
+    def exhaust(self, route, retry_after, bucket=None):
+        """
+        Marks the bucket as exhausted for retry_after seconds, used after a 429
+        """
+        bucket = bucket or self.resolve(route)
+        self._set_local(bucket, 0, retry_after)
+        if self._shared():
+            self._spawn(_UPDATE(
+                self.redis,
+                keys=('%s:%s' % (self.prefix, bucket),),
+                args=(-1, 0, int(retry_after * 1000))
+            ), 'update rate limit bucket %s' % bucket)
+
+
+# KEYS[1] token bucket state, KEYS[2] global block
+# ARGV[1] capacity, ARGV[2] tokens per ms, ARGV[3] requested tokens
+# Returns {granted tokens, ms to wait if nothing was granted}
+_GLOBAL_ACQUIRE = LuaScript(_NOW + """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+
+local blocked = redis.call('PTTL', KEYS[2])
+if blocked > 0 then
+    return {0, blocked}
+end
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], 60000)
+
+if granted > 0 then
+    return {granted, 0}
+end
+
+return {0, math.ceil((1 - tokens) / rate)}
+""")
+
+
+class GlobalLimiter:
+    """
+    Proactive token bucket for the bot-wide requests per second limit
+
+    The bucket lives in redis and is shared by all workers. To avoid a round-trip for every request,
+    tokens are leased in small batches and cached locally for a short time.
+    Without redis (or while redis is unavailable) a local token bucket with the same rate is used.
+
+    Discord counts requests in fixed windows, so a bucket that is allowed to burst would let through up to
+    burst + rate requests in one window. The bucket holds at most `burst` tokens and refills the rest of `rate`.
+    """
+
+    def __init__(self, redis=None, *, rate=50, per=1, burst=None, lease=5, lease_ttl=0.5, prefix='ratelimits',
+                 timeout=0.05, failure_threshold=3, cooldown=10, loop=None):
+        self.redis = redis
+        self.loop = loop or asyncio.get_event_loop()
+        self.rate = rate
+        self.per = per
+        self.burst = burst if burst is not None else max(rate // 10, 1)
+        self.lease = lease
+        self.lease_ttl = lease_ttl
+        self.prefix = prefix
+        self.breaker = RedisBreaker('the shared global rate limit', timeout=timeout,
+                                    failure_threshold=failure_threshold, cooldown=cooldown)
+
+        self._tokens = 0
+        self._lease_expires = 0
+        self._lock = asyncio.Lock()
+
+        # local fallback bucket
+        self._local_tokens = self.burst
+        self._local_ts = self.loop.time()
+
+    def _take_leased(self):
+        if self._tokens > 0 and self._lease_expires > self.loop.time():
+            self._tokens -= 1
+            return True
+
+        return False
+
+    @property
+    def refill(self):
+        """
+        Tokens per second
+        """
+        return max(self.rate - self.burst, 1) / self.per
+
+    def _take_local(self):
+        now = self.loop.time()
+        self._local_tokens = min(self.burst, self._local_tokens + (now - self._local_ts) * self.refill)
+        self._local_ts = now
+        if self._local_tokens >= 1:
+            self._local_tokens -= 1
+            return 0
+
+        return (1 - self._local_tokens) / self.refill
+
+    async def _lease(self):
+        """
+        Returns the number of seconds to wait before trying again or 0 if new tokens were leased
+        """
+        granted, wait = await self.breaker.call(_GLOBAL_ACQUIRE(
+            self.redis,
+            keys=('%s:global' % self.prefix, '%s:global:blocked' % self.prefix),
+            args=(self.burst, self.refill / 1000, self.lease)
+        ))
+        if granted > 0:
+            self._tokens = granted
+            self._lease_expires = self.loop.time() + self.lease_ttl
+            return 0
+
+        return wait / 1000
+
+    async def acquire(self):
+        while True:
+            if self._take_leased():
+                return
+
+            if self.redis is None or self.breaker.open:
+                wait = self._take_local()
+
+            else:
+                async with self._lock:
+                    # Another task might have leased new tokens while we were waiting for the lock
+                    if self._take_leased():
+                        return
+
+                    try:
+                        wait = await self._lease()
+                    except Exception as e:
+                        log.warning('Failed to lease global rate limit tokens (%s: %s)', e.__class__.__name__, e)
+                        wait = self._take_local()
+
+                    else:
+                        if wait <= 0 and self._take_leased():
+                            return
+
+            if wait <= 0:
+                return
+
+            await asyncio.sleep(wait)
+
+    async def block(self, retry_after):
+        """
+        Blocks the global bucket for all workers after we hit a global 429 anyways
+        """
+        self._tokens = 0
+        if self.redis is None or self.breaker.open:
+            return
+
+        try:
+            await self.breaker.call(
+                self.redis.set('%s:global:blocked' % self.prefix, 1, pexpire=max(int(retry_after * 1000), 1))
+            )
+        except Exception as e:
+            log.warning('Failed to block global rate limit (%s: %s)', e.__class__.__name__, e)
+
+
+class InvalidRequestGuard:
+    """
+    Keeps the amount of invalid requests (401, 403 and 429 responses) below the limit discord
+    bans IPs for (10,000 per 10 minutes)
+
+    Invalid responses are counted in a sliding window made of small time slots. With redis the slots are shared
+    by all workers, the local count is synced every `sync_interval` seconds instead of on every response.
+    Once `slowdown` of the limit is used up, requests are delayed more and more, after `block` of the limit
+    is used up, requests wait until the window has moved on far enough.
+    """
+
+    STATUSES = frozenset((401, 403, 429))
+
+    def __init__(self, redis=None, *, limit=10000, window=600, slot=10, slowdown=0.5, block=0.9, max_delay=5,
+                 sync_interval=1, prefix='ratelimits:invalid', loop=None):
+        self.redis = redis
+        self.loop = loop or asyncio.get_event_loop()
+        self.limit = limit
+        self.window = window
+        self.slot = slot
+        self.slowdown = slowdown
+        self.block = block
+        self.max_delay = max_delay
+        self.sync_interval = sync_interval
+        self.prefix = prefix
+
+        self._slots = {}
+        self._pending = 0
+        self._cluster_count = 0
+        self._task = None
+
+    def _current_slot(self):
+        return int(time.time() // self.slot)
+
+    def _local_count(self):
+        oldest = self._current_slot() - self.window // self.slot
+        for s in [s for s in self._slots if s <= oldest]:
+            del self._slots[s]
+
+        return sum(self._slots.values())
+
+    @property
+    def count(self):
+        if self.redis is None:
+            return self._local_count()
+
+        return max(self._cluster_count + self._pending, self._local_count())
+
+    @property
+    def remaining(self):
+        return max(self.limit - self.count, 0)
+
+    def record(self, response):
+        if response.status not in self.STATUSES:
+            return
+
+        # Shared rate limits don't count towards the invalid request limit
+        if response.status == 429 and response.headers.get('X-RateLimit-Scope') == 'shared':
+            return
+
+        slot = self._current_slot()
+        self._slots[slot] = self._slots.get(slot, 0) + 1
+        self._pending += 1
+
+    async def acquire(self):
+        while True:
+            usage = self.count / self.limit
+            if usage < self.slowdown:
+                return
+
+            if usage < self.block:
+                delay = (usage - self.slowdown) / (self.block - self.slowdown) * self.max_delay
+                log.warning('%s of the invalid request limit are used up, delaying request by %.2f seconds',
+                            '{:.0%}'.format(usage), delay)
+                await asyncio.sleep(delay)
+                return
+
+            log.warning('Invalid request limit is almost reached, blocking requests')
+            await asyncio.sleep(self.slot)
+
+    async def sync(self):
+        if self.redis is None:
+            return
+
+        pending, self._pending = self._pending, 0
+        slot = self._current_slot()
+        keys = ['%s:%s' % (self.prefix, slot - i) for i in range(self.window // self.slot)]
+        try:
+            tr = self.redis.multi_exec()
+            if pending:
+                tr.incrby(keys[0], pending)
+                tr.expire(keys[0], self.window + self.slot)
+
+            fut = tr.mget(*keys)
+            await tr.execute()
+            values = await fut
+        except Exception as e:
+            self._pending += pending
+            log.warning('Failed to sync invalid request count (%s: %s)', e.__class__.__name__, e)
+            return
+
+        self._cluster_count = sum(int(v) for v in values if v is not None)
+
+    def collect(self, metrics):
+        metrics.gauge('ratelimits:invalid:count', self.count)
+        metrics.gauge('ratelimits:invalid:remaining', self.remaining)
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception:
+                traceback.print_exc()
+
+    def start(self, redis=None):
+        if redis is not None:
+            self.redis = redis
+
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._sync_loop())
@@ -0,0 +1,274 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from .httpd import Route
+from .scheduler import Priority, request_scope
+
+log = logging.getLogger(__name__)
+
+
+class Ref:
+    """
+    Placeholder for a value of the result of another mutation, usually the id of something it created
+
+    Refs can be used anywhere in the arguments of a mutation (also nested in lists and dicts) and are
+    replaced with the value once the mutation they refer to is done.
+    """
+    __slots__ = ('node', 'key')
+
+    def __init__(self, node, key='id'):
+        self.node = node
+        self.key = key
+
+    def resolve(self, results):
+        result = results[self.node]
+        if self.key is None:
+            return result
+
+        if isinstance(result, dict):
+            return result[self.key]
+
+        return getattr(result, self.key)
+
+    def __repr__(self):
+        return '<Ref node={0.node!r} key={0.key!r}>'.format(self)
+
+
+def _find_refs(value, refs):
+    if isinstance(value, Ref):
+        refs.add(value.node)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _find_refs(v, refs)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            _find_refs(v, refs)
+
+    return refs
+
+
+def _resolve(value, results):
+    if isinstance(value, Ref):
+        return value.resolve(results)
+    elif isinstance(value, dict):
+        return {k: _resolve(v, results) for k, v in value.items()}
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return type(value)(_resolve(v, results) for v in value)
+
+    return value
+
+
+class Mutation:
+    __slots__ = ('id', 'func', 'args', 'kwargs', 'bucket', 'depends')
+
+    def __init__(self, id, func, args, kwargs, bucket, depends):
+        self.id = id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.bucket = bucket
+        self.depends = depends
+
+
+class DependencyFailed(Exception):
+    def __init__(self, node, dependency):
+        self.node = node
+        self.dependency = dependency
+        super().__init__('{0} was skipped because {1} failed'.format(node, dependency))
+
+
+class RestoreResult:
+    def __init__(self, results, errors, skipped, duration):
+        self.results = results
+        self.errors = errors
+        self.skipped = skipped
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return not self.errors and not self.skipped
+
+    def __repr__(self):
+        return '<RestoreResult done={0} failed={1} skipped={2} duration={3:.2f}>'.format(
+            len(self.results), len(self.errors), len(self.skipped), self.duration
+        )
+
+
+class RestoreExecutor:
+    """
+    Runs a graph of dependent mutations as concurrently as the rate limits allow
+
+    Mutations are added with the HTTPClient method (or any coroutine function) that performs them. A mutation
+    starts as soon as all mutations it references with a :class:`Ref` (or lists in `after`) are done, with
+    the Refs in its arguments replaced by the actual values. Instead of a fixed concurrency, at most
+    `per_bucket` mutations of the same rate limit bucket run at a time. The client sends the requests of a
+    bucket one after another anyways, more would only queue up there, while every independent bucket keeps
+    making progress.
+
+    If a mutation fails, everything that depends on it is skipped, unrelated branches carry on.
+    `on_progress(executor)` is called after every finished mutation.
+    """
+
+    def __init__(self, http, *, per_bucket=2, priority=Priority.BULK, key=None, on_progress=None):
+        self.http = http
+        self.per_bucket = per_bucket
+        self.priority = priority
+        self.key = key
+        self.on_progress = on_progress
+
+        self.nodes = {}
+        self.results = {}
+        self.errors = {}
+        self.skipped = {}
+
+    def add(self, id, func, *args, after=(), bucket=None, **kwargs):
+        """
+        Adds a mutation and returns a Ref to its result
+
+        `func` is the name of a HTTPClient method or a coroutine function. The bucket that limits the mutation
+        can be passed as a Route or any hashable, it defaults to the function and its first argument
+        (which is the major parameter for most HTTPClient methods).
+        """
+        if id in self.nodes:
+            raise ValueError('Duplicate mutation id {!r}'.format(id))
+
+        if isinstance(func, str):
+            name = func
+            func = getattr(self.http, func)
+        else:
+            name = getattr(func, '__name__', repr(func))
+
+        if isinstance(bucket, Route):
+            bucket = self.http.buckets.resolve(bucket)
+        elif bucket is None:
+            major = args[0] if args else None
+            bucket = (name, major.node if isinstance(major, Ref) else major)
+
+        depends = _find_refs(kwargs, _find_refs(args, set(after)))
+        self.nodes[id] = Mutation(id, func, args, kwargs, bucket, depends)
+        return Ref(id)
+
+    @property
+    def total(self):
+        return len(self.nodes)
+
+    @property
+    def finished(self):
+        return len(self.results) + len(self.errors) + len(self.skipped)
+
+    @property
+    def progress(self):
+        return self.finished / self.total if self.nodes else 1
+
+    def _check(self):
+        """
+        Raises ValueError if a dependency doesn't exist or the graph has a cycle
+        """
+        for node in self.nodes.values():
+            for dependency in node.depends:
+                if dependency not in self.nodes:
+                    raise ValueError('{!r} depends on unknown mutation {!r}'.format(node.id, dependency))
+
+        visited = {}
+
+        for start in self.nodes:
+            if start in visited:
+                continue
+
+            stack = [(start, iter(self.nodes[start].depends))]
+            visited[start] = 1
+            while stack:
+                current, dependencies = stack[-1]
+                for dependency in dependencies:
+                    state = visited.get(dependency)
+                    if state == 1:
+                        raise ValueError('Dependency cycle through {!r}'.format(dependency))
+
+                    if state is None:
+                        visited[dependency] = 1
+                        stack.append((dependency, iter(self.nodes[dependency].depends)))
+                        break
+                else:
+                    visited[current] = 2
+                    stack.pop()
+
+    def _report(self):
+        if self.on_progress is not None:
+            try:
+                self.on_progress(self)
+            except Exception:
+                log.exception('Restore progress callback failed')
+
+    async def _execute(self, node):
+        return await node.func(*_resolve(node.args, self.results), **_resolve(node.kwargs, self.results))
+
+    def _skip(self, node_id, dependency, children):
+        pending = [node_id]
+        while pending:
+            current = pending.pop()
+            if current in self.skipped:
+                continue
+
+            self.skipped[current] = DependencyFailed(current, dependency)
+            pending.extend(children.get(current, ()))
+
+    async def run(self):
+        self._check()
+        start = time.perf_counter()
+
+        children = {}
+        waiting = {}
+        for node in self.nodes.values():
+            waiting[node.id] = len(node.depends)
+            for dependency in node.depends:
+                children.setdefault(dependency, []).append(node.id)
+
+        ready = {}
+        for node in self.nodes.values():
+            if not node.depends:
+                ready.setdefault(node.bucket, deque()).append(node)
+
+        in_flight = {}
+        running = {}
+        try:
+            with request_scope(priority=self.priority, key=self.key):
+                while True:
+                    for bucket, queue in list(ready.items()):
+                        while queue and in_flight.get(bucket, 0) < self.per_bucket:
+                            node = queue.popleft()
+                            in_flight[bucket] = in_flight.get(bucket, 0) + 1
+                            running[asyncio.ensure_future(self._execute(node))] = node
+
+                        if not queue:
+                            del ready[bucket]
+
+                    if not running:
+                        break
+
+                    done, _ = await asyncio.wait(running.keys(), return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        node = running.pop(task)
+                        in_flight[node.bucket] -= 1
+                        error = task.exception()
+                        if error is not None:
+                            log.warning('Mutation %s failed (%s: %s)', node.id, error.__class__.__name__, error)
+                            self.errors[node.id] = error
+                            for child in children.get(node.id, ()):
+                                self._skip(child, node.id, children)
+
+                        else:
+                            self.results[node.id] = task.result()
+                            for child in children.get(node.id, ()):
+                                waiting[child] -= 1
+                                if waiting[child] == 0 and child not in self.skipped:
+                                    child_node = self.nodes[child]
+                                    ready.setdefault(child_node.bucket, deque()).append(child_node)
+
+                        self._report()
+        finally:
+            for task in running:
+                task.cancel()
+
+        return RestoreResult(self.results, self.errors, self.skipped, time.perf_counter() - start)
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+
+from .errors import CircuitOpen
+from .ratelimits import RedisBreaker
+
+log = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'))
+# Gateway timeouts and unavailable upstreams don't tell whether discord already processed the request
+AMBIGUOUS_STATUSES = frozenset((503, 504))
+
+
+class RetryPolicy:
+    """
+    Decides whether and when a failed request is retried
+
+    Backoff is exponential with full jitter: a random delay between 0 and min(cap, base * 2 ** attempt).
+    Connection errors, timeouts and 503/504 responses are only retried for idempotent methods by default,
+    because we can't know whether discord already processed the request.
+    """
+
+    def __init__(self, tries=5, *, statuses=(500, 502, 503, 504), base=0.5, cap=30,
+                 retry_connection_errors=True, idempotent_only=False):
+        self.tries = tries
+        self.statuses = frozenset(statuses)
+        self.base = base
+        self.cap = cap
+        self.retry_connection_errors = retry_connection_errors
+        self.idempotent_only = idempotent_only
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def should_retry(self, method, status=None, error=None):
+        if self.idempotent_only and method not in IDEMPOTENT_METHODS:
+            return False
+
+        if error is not None:
+            if not self.retry_connection_errors or method not in IDEMPOTENT_METHODS:
+                return False
+
+            return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+        if status in AMBIGUOUS_STATUSES and method not in IDEMPOTENT_METHODS:
+            return False
+
+        return status in self.statuses
+
+
+class RetryBudget:
+    """
+    Limits the amount of retries so they can't amplify an outage
+
+    Locally every successful request deposits `ratio` retry tokens (up to `burst`) and every retry withdraws one.
+    If redis is set, retries are additionally capped at `cluster_limit` per `window` seconds across all workers.
+    The cluster wide check gives up after `timeout` seconds and is skipped for a while if redis keeps failing.
+    """
+
+    def __init__(self, redis=None, *, ratio=0.1, burst=20, cluster_limit=100, window=10, prefix='retries',
+                 timeout=0.05, failure_threshold=3, cooldown=10):
+        self.redis = redis
+        self.ratio = ratio
+        self.burst = burst
+        self.cluster_limit = cluster_limit
+        self.window = window
+        self.prefix = prefix
+        self.breaker = RedisBreaker('the cluster retry budget', timeout=timeout,
+                                    failure_threshold=failure_threshold, cooldown=cooldown)
+
+        self._tokens = float(burst)
+
+    def deposit(self):
+        self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    async def _count(self):
+        key = '%s:%s' % (self.prefix, int(time.time() // self.window))
+        tr = self.redis.multi_exec()
+        fut = tr.incr(key)
+        tr.expire(key, self.window * 2)
+        await tr.execute()
+        return await fut
+
+    async def withdraw(self):
+        if self._tokens < 1:
+            return False
+
+        if self.redis is not None and self.cluster_limit is not None and not self.breaker.open:
+            try:
+                if await self.breaker.call(self._count()) > self.cluster_limit:
+                    return False
+            except Exception as e:
+                # Fall back to the local budget
+                log.warning('Failed to check cluster retry budget (%s: %s)', e.__class__.__name__, e)
+
+        self._tokens -= 1
+        return True
+
+
+class RetryEngine:
+    def __init__(self, default=None, *, budget=None, metrics=None):
+        self.default = default or RetryPolicy()
+        self.budget = budget or RetryBudget()
+        self.metrics = metrics
+        self.policies = {}
+
+    def set_policy(self, method, path, policy):
+        self.policies['%s:%s' % (method, path)] = policy
+
+    def policy_for(self, route):
+        return self.policies.get(route.label, self.default)
+
+    def success(self):
+        self.budget.deposit()
+
+    async def retry(self, route, policy, attempt, *, status=None, error=None):
+        """
+        Returns the time to wait before the next attempt or None if the request shouldn't be retried
+        """
+        if attempt + 1 >= policy.tries or not policy.should_retry(route.method, status, error):
+            return None
+
+        if not await self.budget.withdraw():
+            if self.metrics is not None:
+                self.metrics.incr("retries:exhausted", route.label)
+
+            log.warning('Retry budget exhausted, not retrying %s %s', route.method, route.url)
+            return None
+
+        if self.metrics is not None:
+            self.metrics.incr("retries", route.label)
+
+        return policy.backoff(attempt)
+
+
+class CircuitBreaker:
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    def __init__(self, label, *, threshold=5, reset_timeout=30):
+        self.label = label
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0
+        self._probe_started = None
+
+    def before(self):
+        """
+        Raises CircuitOpen if the request should not be sent
+        """
+        if self.state == self.CLOSED:
+            return
+
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            remaining = self._opened_at + self.reset_timeout - now
+            if remaining > 0:
+                raise CircuitOpen(self.label, remaining)
+
+            self.state = self.HALF_OPEN
+            self._probe_started = None
+
+        # Only let one probe through at a time, unless the last one never reported back
+        if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+            raise CircuitOpen(self.label, self._probe_started + self.reset_timeout - now)
+
+        self._probe_started = now
+
+    def success(self):
+        if self.state != self.CLOSED:
+            log.info('Circuit for %s is closed again', self.label)
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_started = None
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                log.warning('Circuit for %s is open after %s failures', self.label, self.failures)
+
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._probe_started = None
+
+
+class CircuitBreakers:
+    """
+    One circuit breaker per route template
+
+    A breaker opens after `threshold` consecutive server errors or connection failures and rejects all requests
+    of its route with CircuitOpen for `reset_timeout` seconds. After that a single probe request is let through,
+    which either closes the circuit again or re-opens it.
+    """
+
+    def __init__(self, *, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+
+    def get(self, route):
+        breaker = self.breakers.get(route.label)
+        if breaker is None:
+            breaker = self.breakers[route.label] = CircuitBreaker(
+                route.label,
+                threshold=self.threshold,
+                reset_timeout=self.reset_timeout
+            )
+
+        return breaker
+
+    def collect(self, metrics):
+        open_circuits = 0
+        for label, breaker in self.breakers.items():
+            if breaker.state != breaker.CLOSED:
+                open_circuits += 1
+
+            metrics.gauge("circuits:%s" % label, breaker.state)
+
+        metrics.gauge("circuits:open", open_circuits)
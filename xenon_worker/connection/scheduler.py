@@ -0,0 +1,291 @@
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from enum import IntEnum
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # replies to users
+    NORMAL = 1
+    BULK = 2  # backups, restores and other long running jobs
+
+
+_priority = contextvars.ContextVar('request_priority', default=Priority.NORMAL)
+_fair_key = contextvars.ContextVar('request_fair_key', default=None)
+_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+@contextmanager
+def request_scope(priority=None, key=None, *, timeout=None, deadline=None):
+    """
+    Sets the priority, fair queueing key and deadline for all requests made inside this scope,
+    including the ones made by tasks created inside of it
+
+    deadline is an absolute time.monotonic() value, timeout is relative to now.
+    Requests that are still waiting when the deadline has passed are dropped.
+    """
+    tokens = []
+    if priority is not None:
+        tokens.append((_priority, _priority.set(priority)))
+    if key is not None:
+        tokens.append((_fair_key, _fair_key.set(str(key))))
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    if deadline is not None:
+        tokens.append((_deadline, _deadline.set(deadline)))
+
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def current_priority():
+    return _priority.get()
+
+
+def current_key():
+    return _fair_key.get()
+
+
+def current_deadline():
+    return _deadline.get()
+
+
+async def without_deadline(coro):
+    """
+    Runs the coroutine without the deadline of the current scope, has to be wrapped in its own task
+    """
+    _deadline.set(None)
+    return await coro
+
+
+def time_left():
+    """
+    Returns the seconds left until the deadline of the current scope or None if there is no deadline
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+
+    return deadline - time.monotonic()
+
+
+class RequestScheduler:
+    """
+    Limits the number of concurrent requests
+
+    Waiting requests are queued in one lane per priority. Higher priority lanes are always served first and
+    `reserved` slots can only be used by interactive requests, so replies stay fast even if all other slots are
+    taken by bulk work. Inside of a lane, keys (usually guilds) are served round robin so that one guild can't
+    monopolize the lane. A key with a weight of n gets up to n consecutive slots per round.
+    """
+
+    def __init__(self, limit=50, *, reserved=5, metrics=None, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.limit = limit
+        self.reserved = reserved
+        self.metrics = metrics
+        self.running = 0
+        self.weights = {}
+
+        # priority -> key -> [waiters, credit]
+        self.lanes = {p: OrderedDict() for p in Priority}
+        self._queued = {p: 0 for p in Priority}
+
+    @property
+    def queued(self):
+        return sum(self._queued.values())
+
+    def _capacity(self, priority):
+        if priority == Priority.INTERACTIVE:
+            return self.limit
+
+        return max(self.limit - self.reserved, 1)
+
+    def _has_waiters(self, max_priority):
+        return any(self._queued[p] for p in Priority if p <= max_priority)
+
+    def _update_gauges(self):
+        if self.metrics is None:
+            return
+
+        self.metrics.gauge("requests:running", self.running)
+        self.metrics.gauge("requests:waiting", self.queued)
+        for priority, queued in self._queued.items():
+            self.metrics.gauge("requests:waiting:%s" % priority.name.lower(), queued)
+
+    def _pop(self, priority):
+        lane = self.lanes[priority]
+        while lane:
+            key, entry = next(iter(lane.items()))
+            waiters = entry[0]
+            fut = waiters.popleft()
+            self._queued[priority] -= 1
+            entry[1] -= 1
+
+            if not waiters:
+                del lane[key]
+            elif entry[1] <= 0:
+                entry[1] = self.weights.get(key, 1)
+                lane.move_to_end(key)
+
+            if not fut.done():
+                return fut
+
+        return None
+
+    def _wake(self):
+        for priority in Priority:
+            while self._queued[priority] and self.running < self._capacity(priority):
+                fut = self._pop(priority)
+                if fut is None:
+                    break
+
+                self.running += 1
+                fut.set_result(None)
+
+        self._update_gauges()
+
+    def _remove(self, priority, key, fut):
+        lane = self.lanes[priority]
+        entry = lane.get(key)
+        if entry is None:
+            return
+
+        try:
+            entry[0].remove(fut)
+        except ValueError:
+            return
+
+        self._queued[priority] -= 1
+        if not entry[0]:
+            del lane[key]
+
+    async def acquire(self, priority=None, key=None):
+        priority = Priority(current_priority() if priority is None else priority)
+        if key is None:
+            key = current_key()
+
+        if self.running < self._capacity(priority) and not self._has_waiters(priority):
+            self.running += 1
+            self._update_gauges()
+            return
+
+        fut = self.loop.create_future()
+        lane = self.lanes[priority]
+        entry = lane.get(key)
+        if entry is None:
+            entry = lane[key] = [deque(), self.weights.get(key, 1)]
+
+        entry[0].append(fut)
+        self._queued[priority] += 1
+        self._update_gauges()
+
+        start = time.perf_counter()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # We got the slot but were cancelled before we could use it
+                self.release()
+            else:
+                self._remove(priority, key, fut)
+                self._update_gauges()
+
+            raise
+
+        if self.metrics is not None:
+            self.metrics.observe("requests:wait", priority.name.lower(), time.perf_counter() - start)
+
+    def release(self):
+        self.running -= 1
+        self._wake()
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self._wake()
+
+
+class AdaptiveConcurrency:
+    """
+    Sizes the limit of a RequestScheduler based on the observed latency and error rates (AIMD)
+
+    The limit is increased by one for every `limit` successful requests while the scheduler is actually using its
+    slots, and multiplied by `backoff` when discord returns 5xx errors or global 429s, a request fails on the
+    connection level or the latency climbs above `tolerance` times the baseline latency.
+    Latency is smoothed (EWMA with `smoothing`) before it's compared, single slow responses are normal.
+    Decreases happen at most once per `cooldown` seconds, so a burst of errors doesn't collapse the limit.
+    """
+
+    def __init__(self, scheduler, *, min_limit=5, max_limit=200, backoff=0.75, tolerance=3.0, smoothing=0.1,
+                 cooldown=1, metrics=None):
+        self.scheduler = scheduler
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.cooldown = cooldown
+        self.metrics = metrics
+
+        self.limit = float(min(max(scheduler.limit, min_limit), max_limit))
+        self.latency = None
+        self.baseline = None
+        self._last_decrease = 0
+        self._apply()
+
+    def _apply(self):
+        limit = int(self.limit)
+        if limit != self.scheduler.limit:
+            self.scheduler.set_limit(limit)
+
+        if self.metrics is not None:
+            self.metrics.gauge("requests:limit", limit)
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self._apply()
+
+    def _increase(self):
+        # Only grow if we actually need the slots
+        if self.scheduler.running + self.scheduler.queued < self.scheduler.limit / 2:
+            return
+
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._apply()
+
+    def sample(self, latency=None, status=None, *, overload=False):
+        """
+        Records the outcome of a request
+
+        latency is None if the request failed before a response was received.
+        """
+        if overload or latency is None or (status is not None and status >= 500):
+            self._decrease()
+            return
+
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) * self.smoothing
+
+        if self.baseline is None or self.latency < self.baseline:
+            self.baseline = self.latency
+        else:
+            # Let the baseline drift upwards slowly so it can adapt to a permanent change in latency
+            self.baseline += (self.latency - self.baseline) * 0.01
+
+        if self.latency > self.baseline * self.tolerance:
+            self._decrease()
+
+        elif status is None or status < 400:
+            self._increase()
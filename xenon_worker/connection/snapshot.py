@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import time
+
+from .entities import Guild, Member, User, Webhook
+from .errors import Forbidden
+from .scheduler import Priority, request_scope
+
+log = logging.getLogger(__name__)
+
+
+class GuildSnapshot:
+    """
+    Everything a backup needs to know about a guild at one point in time
+
+    `members` and `bans` are None if they were streamed to a sink instead of being collected.
+    Parts that couldn't be fetched because of missing permissions are None and their error is in `errors`.
+    """
+
+    def __init__(self, guild, *, webhooks=None, members=None, bans=None, member_count=0, ban_count=0,
+                 errors=None, created_at=None, duration=0):
+        self.guild = guild
+        self.webhooks = webhooks
+        self.members = members
+        self.bans = bans
+        self.member_count = member_count
+        self.ban_count = ban_count
+        self.errors = errors or {}
+        self.created_at = created_at or time.time()
+        self.duration = duration
+
+    @property
+    def channels(self):
+        return self.guild.channels
+
+    @property
+    def roles(self):
+        return self.guild.roles
+
+    @property
+    def emojis(self):
+        return self.guild.emojis
+
+    def to_dict(self):
+        data = {
+            "guild": self.guild.to_dict(),
+            "webhooks": [w.to_dict() for w in self.webhooks] if self.webhooks is not None else None,
+            "members": [m.to_dict() for m in self.members] if self.members is not None else None,
+            "bans": [{**b, "user": b["user"].to_dict()} for b in self.bans] if self.bans is not None else None,
+            "member_count": self.member_count,
+            "ban_count": self.ban_count,
+            "created_at": self.created_at
+        }
+        return data
+
+
+class SnapshotBuilder:
+    """
+    Fetches all parts of a guild concurrently
+
+    The guild (with roles and emojis), channels, webhooks, members and bans all have their own rate limit
+    bucket, so fetching them at the same time takes about as long as the slowest of them instead of the sum.
+    Members and bans are paginated. The next page is already requested while the current one is handed to the
+    sink, and if a sink is set nothing is buffered. Without a sink they are collected into the snapshot.
+    All requests are made with bulk priority and queued fairly under the guild id, so interactive requests of
+    other guilds aren't slowed down.
+    """
+
+    def __init__(self, client, guild_id, *, webhooks=True, members=True, bans=True, member_sink=None,
+                 ban_sink=None, page_size=1000, priority=Priority.BULK):
+        self.client = client
+        self.http = client.http
+        self.guild_id = guild_id
+        self.webhooks = webhooks
+        self.members = members
+        self.bans = bans
+        self.member_sink = member_sink
+        self.ban_sink = ban_sink
+        self.page_size = page_size
+        self.priority = priority
+
+    async def _fetch_guild(self):
+        data, channels = await asyncio.gather(
+            self.http.get_guild(self.guild_id),
+            self.http.get_guild_channels(self.guild_id)
+        )
+        data["channels"] = channels
+        return Guild(data)
+
+    async def _fetch_webhooks(self):
+        return [Webhook(w) for w in await self.http.guild_webhooks(self.guild_id)]
+
+    async def _paginate(self, fetch, key, sink):
+        """
+        Requests page after page and passes every item to the sink, returns the number of items
+        """
+        count = 0
+        after = None
+        next_page = asyncio.ensure_future(fetch(self.page_size, None))
+        try:
+            while next_page is not None:
+                page = await next_page
+                next_page = None
+                if not page:
+                    break
+
+                last = key(page[-1])
+                # Discord ignores the pagination of some routes and returns everything at once
+                if len(page) == self.page_size and last != after:
+                    after = last
+                    next_page = asyncio.ensure_future(fetch(self.page_size, after))
+
+                for item in page:
+                    await sink(item)
+
+                count += len(page)
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+        return count
+
+    async def _stream(self, fetch, key, convert, sink):
+        if sink is not None:
+            async def _sink(item):
+                await sink(convert(item))
+
+            return None, await self._paginate(fetch, key, _sink)
+
+        items = []
+
+        async def _collect(item):
+            items.append(convert(item))
+
+        count = await self._paginate(fetch, key, _collect)
+        return items, count
+
+    def _fetch_members(self):
+        return self._stream(
+            lambda limit, after: self.http.get_members(self.guild_id, limit, after),
+            lambda m: m["user"]["id"],
+            Member,
+            self.member_sink
+        )
+
+    def _fetch_bans(self):
+        def _ban(data):
+            return {"user": User(data["user"]), "reason": data.get("reason")}
+
+        return self._stream(
+            lambda limit, after: self.http.get_bans(self.guild_id, limit=limit, after=after),
+            lambda b: b["user"]["id"],
+            _ban,
+            self.ban_sink
+        )
+
+    async def build(self):
+        start = time.perf_counter()
+        with request_scope(priority=self.priority, key=str(self.guild_id)):
+            parts = {"guild": self._fetch_guild()}
+            if self.webhooks:
+                parts["webhooks"] = self._fetch_webhooks()
+            if self.members:
+                parts["members"] = self._fetch_members()
+            if self.bans:
+                parts["bans"] = self._fetch_bans()
+
+            results = await asyncio.gather(*parts.values(), return_exceptions=True)
+
+        results = dict(zip(parts.keys(), results))
+        errors = {}
+        for name, result in results.items():
+            if isinstance(result, BaseException):
+                # Missing permissions only cost us that part of the snapshot
+                if name == "guild" or not isinstance(result, Forbidden):
+                    raise result
+
+                log.debug('Failed to fetch %s of guild %s (%s)', name, self.guild_id, result)
+                errors[name] = result
+                results[name] = None
+
+        members, member_count = results.get("members") or (None, 0)
+        bans, ban_count = results.get("bans") or (None, 0)
+        return GuildSnapshot(
+            results["guild"],
+            webhooks=results.get("webhooks"),
+            members=members,
+            bans=bans,
+            member_count=member_count,
+            ban_count=ban_count,
+            errors=errors,
+            duration=time.perf_counter() - start
+        )
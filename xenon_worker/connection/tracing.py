@@ -0,0 +1,152 @@
+import logging
+import time
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+# Most phases take a few milliseconds, but waiting for a bucket can take seconds
+TIMING_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Phases in the order they happen
+PHASES = ('guard', 'bucket_lock', 'bucket', 'global', 'scheduler', 'pool', 'dns', 'connection', 'ttfb', 'body')
+
+
+class RequestTimings:
+    """
+    Phase timings of a single request attempt
+
+    Sequential phases are recorded with `mark`, which attributes the time since the previous mark to the phase.
+    Phases that happen inside another one (pool and dns are part of connection) are recorded with `span`.
+    """
+    __slots__ = ('phases', 'started', '_last')
+
+    def __init__(self):
+        self.phases = {}
+        self.started = self._last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self._last
+        self._last = now
+
+    def span(self, phase, start):
+        self.phases[phase] = self.phases.get(phase, 0) + time.perf_counter() - start
+
+    @property
+    def total(self):
+        return self._last - self.started
+
+
+class _NullTimings:
+    __slots__ = ()
+
+    phases = {}
+    total = 0
+
+    def mark(self, phase):
+        pass
+
+    def span(self, phase, start):
+        pass
+
+
+_NULL_TIMINGS = _NullTimings()
+
+
+class RequestTracer:
+    """
+    Records where the time of every request is spent
+
+    The client marks the phases it controls (invalid request guard, global limit, bucket lock, cluster bucket and
+    scheduler), the aiohttp trace hooks mark connection pool waits, DNS lookups, connection setup and the time
+    to the first byte of the response. Every phase is aggregated into a per-route histogram
+    ``timings:<phase>`` that is flushed with the other metrics. Attempts that took longer than
+    `slow_threshold` seconds are logged with their breakdown.
+    """
+
+    def __init__(self, metrics, *, enabled=True, slow_threshold=5):
+        self.metrics = metrics
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold
+
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_request_start.append(self._on_request_start)
+        self.trace_config.on_connection_queued_start.append(self._on_queued_start)
+        self.trace_config.on_connection_queued_end.append(self._on_queued_end)
+        self.trace_config.on_dns_resolvehost_start.append(self._on_dns_start)
+        self.trace_config.on_dns_resolvehost_end.append(self._on_dns_end)
+        self.trace_config.on_connection_create_end.append(self._on_connection_ready)
+        self.trace_config.on_connection_reuseconn.append(self._on_connection_ready)
+        self.trace_config.on_request_end.append(self._on_request_end)
+
+    def timings(self):
+        """
+        Returns the timings object for a new attempt, pass it to aiohttp as `trace_request_ctx`
+        """
+        if not self.enabled:
+            return _NULL_TIMINGS
+
+        return RequestTimings()
+
+    def record(self, route, timings, status=None):
+        if timings is _NULL_TIMINGS:
+            return
+
+        for phase, value in timings.phases.items():
+            self.metrics.observe("timings:%s" % phase, route.label, value, bounds=TIMING_BOUNDS)
+
+        if self.slow_threshold is not None and timings.total >= self.slow_threshold:
+            log.info(
+                'Slow request %s %s (%s, %.2fs): %s', route.method, route.url, status, timings.total,
+                ', '.join('%s %.3fs' % (p, timings.phases[p]) for p in PHASES if p in timings.phases)
+            )
+
+    def summary(self, percentiles=(0.5, 0.95, 0.99)):
+        """
+        Returns the timings of all requests since the process started as {route: {phase: stats}}
+        """
+        result = {}
+        for phase in PHASES:
+            for label, hist in self.metrics.histograms("timings:%s" % phase).items():
+                stats = {'count': hist.count, 'mean': hist.sum / hist.count if hist.count else 0}
+                for p in percentiles:
+                    stats['p%g' % (p * 100)] = hist.percentile(p)
+
+                result.setdefault(label, {})[phase] = stats
+
+        return result
+
+    # aiohttp trace hooks, trace_request_ctx is None for requests that aren't sent by HTTPClient._request
+
+    @staticmethod
+    async def _on_request_start(session, ctx, params):
+        ctx.queued = ctx.dns = None
+
+    @staticmethod
+    async def _on_queued_start(session, ctx, params):
+        ctx.queued = time.perf_counter()
+
+    @staticmethod
+    async def _on_queued_end(session, ctx, params):
+        if ctx.trace_request_ctx is not None and ctx.queued is not None:
+            ctx.trace_request_ctx.span('pool', ctx.queued)
+
+    @staticmethod
+    async def _on_dns_start(session, ctx, params):
+        ctx.dns = time.perf_counter()
+
+    @staticmethod
+    async def _on_dns_end(session, ctx, params):
+        if ctx.trace_request_ctx is not None and ctx.dns is not None:
+            ctx.trace_request_ctx.span('dns', ctx.dns)
+
+    @staticmethod
+    async def _on_connection_ready(session, ctx, params):
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx.mark('connection')
+
+    @staticmethod
+    async def _on_request_end(session, ctx, params):
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx.mark('ttfb')
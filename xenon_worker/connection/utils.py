@@ -1,12 +1,70 @@
 import ujson as json
 import asyncio
 import datetime
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _ujson_backend():
+    import ujson
+    return lambda obj: ujson.dumps(obj, ensure_ascii=True).encode('utf-8'), ujson.loads
+
+
+def _orjson_backend():
+    import orjson
+    return orjson.dumps, orjson.loads
+
+
+def _json_backend():
+    import json as _json
+    return lambda obj: _json.dumps(obj, ensure_ascii=True).encode('utf-8'), _json.loads
+
+
+JSON_BACKENDS = {
+    'orjson': _orjson_backend,
+    'ujson': _ujson_backend,
+    'json': _json_backend
+}
+
+_dumps, _loads = _ujson_backend()
+
+
+def use_json_backend(*names):
+    """
+    Selects the first available json backend for requests and responses
+
+    Falls back to ujson (the default) if none of them is available.
+    """
+    global _dumps, _loads
+    for name in names:
+        try:
+            _dumps, _loads = JSON_BACKENDS[name]()
+        except ImportError:
+            continue
+
+        return name
+
+    log.warning('None of the json backends %s is available, using ujson', names)
+    _dumps, _loads = _ujson_backend()
+    return 'ujson'
 
 
 def to_json(obj):
     return json.dumps(obj, ensure_ascii=True)
 
 
+def to_json_bytes(obj):
+    return _dumps(obj)
+
+
+def from_json(data):
+    """
+    Accepts bytes or str
+    """
+    return _loads(data)
+
+
 async def sane_wait_for(futures, *, timeout):
     ensured = [
         asyncio.ensure_future(fut) for fut in futures
@@ -20,16 +78,17 @@ async def sane_wait_for(futures, *, timeout):
 
 
 async def json_or_text(response):
-    text = await response.text(encoding='utf-8')
+    # Parse the raw body, decoding it to a str first is just overhead for large responses
+    body = await response.read()
     try:
         if response.headers['content-type'] == 'application/json':
-            return json.loads(text)
+            return _loads(body)
     except KeyError:
         # Thanks Cloudflare
 
         pass
 
-    return text
+    return body.decode('utf-8')
 
 
 def _parse_ratelimit_header(request, *, use_clock=False):
@@ -0,0 +1,148 @@
+"""
+Load driver for the HTTPClient
+
+Runs the mock discord api and a HTTPClient in the same process and reports throughput, latency and 429s.
+Run it with ``python -m xenon_worker.mock.load --help``.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+from ..connection.httpd import HTTPClient, Route
+from .server import MockDiscord
+
+
+class LoadReport:
+    def __init__(self):
+        self.latencies = []
+        self.errors = Counter()
+        self.duration = 0
+        self.server_stats = Counter()
+
+    @property
+    def requests(self):
+        return len(self.latencies) + sum(self.errors.values())
+
+    @property
+    def rps(self):
+        return self.requests / self.duration if self.duration else 0
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0
+
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+    def __str__(self):
+        lines = [
+            'requests:  %s in %.2fs (%.1f/s)' % (self.requests, self.duration, self.rps),
+            'latency:   p50 %.1fms  p95 %.1fms  p99 %.1fms  max %.1fms' % (
+                self.percentile(0.5) * 1000, self.percentile(0.95) * 1000,
+                self.percentile(0.99) * 1000, self.percentile(1) * 1000
+            ),
+            '429s:      %s bucket, %s global' % (
+                self.server_stats.get('429:bucket', 0), self.server_stats.get('429:global', 0)
+            ),
+            'server:    %s' % dict(self.server_stats)
+        ]
+        if self.errors:
+            lines.append('errors:    %s' % dict(self.errors))
+
+        return '\n'.join(lines)
+
+
+async def run_load(http, calls, *, total=1000, concurrency=50):
+    """
+    Makes `total` calls with `concurrency` concurrent callers
+
+    calls is a list of functions that take the http client and return an awaitable, e.g.
+    lambda http: http.get_channel(channel_id)
+    """
+    report = LoadReport()
+    remaining = total
+
+    async def _worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            call = random.choice(calls)
+            start = time.perf_counter()
+            try:
+                await call(http)
+            except Exception as e:
+                report.errors[e.__class__.__name__] += 1
+            else:
+                report.latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_worker() for _ in range(concurrency)])
+    report.duration = time.perf_counter() - start
+    return report
+
+
+def default_calls(guilds=10, channels=5):
+    guild_ids = [str(100000000000000000 + i) for i in range(guilds)]
+    channel_ids = [str(200000000000000000 + i) for i in range(guilds * channels)]
+    return [
+        lambda http: http.get_channel(random.choice(channel_ids)),
+        lambda http: http.get_guild(random.choice(guild_ids)),
+        lambda http: http.get_roles(random.choice(guild_ids)),
+        lambda http: http.get_member(random.choice(guild_ids), '300000000000000000'),
+        lambda http: http.send_message(random.choice(channel_ids), 'load test'),
+        lambda http: http.edit_channel(random.choice(channel_ids), name='load-test')
+    ]
+
+
+async def main(args):
+    server = MockDiscord(
+        bucket_limit=args.bucket_limit,
+        bucket_per=args.bucket_per,
+        global_limit=args.global_limit,
+        latency=(args.min_latency, args.max_latency),
+        error_rate=args.error_rate
+    )
+    await server.start()
+    Route.set_base(server.url)
+
+    http = HTTPClient(concurrency=args.concurrency)
+    try:
+        await http.static_login('mock', warmup=False)
+        report = await run_load(
+            http,
+            default_calls(args.guilds, args.channels),
+            total=args.requests,
+            concurrency=args.callers
+        )
+        report.server_stats = server.stats
+        print(report)
+        if args.timings:
+            for label, phases in sorted(http.tracer.summary().items()):
+                print(label)
+                for phase, stats in phases.items():
+                    print('    %-12s n=%-5s mean %.1fms  p95 <= %.1fms' % (
+                        phase, stats['count'], stats['mean'] * 1000, stats['p95'] * 1000
+                    ))
+    finally:
+        await http.close()
+        await server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the HTTPClient against a local mock of the discord api')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--callers', type=int, default=100, help='concurrent callers')
+    parser.add_argument('--concurrency', type=int, default=50, help='initial concurrency limit of the client')
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--channels', type=int, default=5, help='channels per guild')
+    parser.add_argument('--bucket-limit', type=int, default=5)
+    parser.add_argument('--bucket-per', type=float, default=5)
+    parser.add_argument('--global-limit', type=int, default=50)
+    parser.add_argument('--min-latency', type=float, default=0.02)
+    parser.add_argument('--max-latency', type=float, default=0.1)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--timings', action='store_true', help='print the phase timings of every route')
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import random
+import re
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from ..connection import utils
+
+# Segments that are followed by a major parameter
+MAJOR_SEGMENTS = ('channels', 'guilds', 'webhooks')
+
+# Last segments of routes that return lists
+COLLECTIONS = {'channels', 'roles', 'members', 'bans', 'emojis', 'invites', 'webhooks', 'pins', 'guilds',
+               'messages', 'relationships'}
+
+_ID = re.compile(r'^\d{15,21}$')
+
+
+def _snowflake():
+    return str(((int(time.time() * 1000) - 1420070400000) << 22) | random.randint(0, 1 << 22))
+
+
+class Bucket:
+    __slots__ = ('limit', 'per', 'remaining', 'reset')
+
+    def __init__(self, limit, per):
+        self.limit = limit
+        self.per = per
+        self.remaining = limit
+        self.reset = 0
+
+    def take(self, now):
+        if now >= self.reset:
+            self.remaining = self.limit
+            self.reset = now + self.per
+
+        if self.remaining <= 0:
+            return False
+
+        self.remaining -= 1
+        return True
+
+
+class MockDiscord:
+    """
+    Local mock of the discord REST api for load tests
+
+    Routes are matched generically, ids after channels, guilds and webhooks are treated as major parameters.
+    Every route bucket has a limit of `bucket_limit` requests per `bucket_per` seconds (overwritable per
+    template with `limits`) and the whole bot can make `global_limit` requests per second. Responses carry
+    realistic X-RateLimit-* headers and the body of rate limited requests matches the one discord sends.
+    `latency` (min, max) and `error_rate` can be used to inject slow responses and 500/502 errors.
+    """
+
+    def __init__(self, *, host='127.0.0.1', port=0, bucket_limit=5, bucket_per=5, global_limit=50, limits=None,
+                 latency=(0, 0), error_rate=0):
+        self.host = host
+        self.port = port
+        self.bucket_limit = bucket_limit
+        self.bucket_per = bucket_per
+        self.global_limit = global_limit
+        self.limits = limits or {}
+        self.latency = latency
+        self.error_rate = error_rate
+
+        self.buckets = {}
+        self.stats = Counter()
+        self._global = Bucket(global_limit, 1)
+
+        self.app = web.Application()
+        self.app.router.add_route('*', '/api/v8/{tail:.*}', self.handle)
+        self.runner = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s/api/v8' % (self.host, self.port)
+
+    @staticmethod
+    def parse(method, path):
+        """
+        Returns the template and the major parameters of a path
+        """
+        segments = path.strip('/').split('/')
+        template = []
+        major = []
+        for i, segment in enumerate(segments):
+            if _ID.match(segment):
+                if i > 0 and segments[i - 1] in MAJOR_SEGMENTS:
+                    major.append(segment)
+                    template.append('{%s_id}' % segments[i - 1][:-1])
+                else:
+                    template.append('{id}')
+            else:
+                template.append(segment)
+
+        return '%s /%s' % (method, '/'.join(template)), major
+
+    def _json(self, data, status=200, headers=None):
+        return web.Response(status=status, body=utils.to_json_bytes(data), content_type='application/json',
+                            headers=headers)
+
+    def _ratelimit_headers(self, template, bucket, now):
+        return {
+            'Via': '1.1 google',
+            'X-RateLimit-Bucket': hashlib.md5(template.encode()).hexdigest()[:16],
+            'X-RateLimit-Limit': str(bucket.limit),
+            'X-RateLimit-Remaining': str(bucket.remaining),
+            'X-RateLimit-Reset': '%.3f' % (time.time() + bucket.reset - now),
+            'X-RateLimit-Reset-After': '%.3f' % max(bucket.reset - now, 0)
+        }
+
+    async def handle(self, request):
+        self.stats['requests'] += 1
+        now = time.monotonic()
+        template, major = self.parse(request.method, request.match_info['tail'])
+
+        if not self._global.take(now):
+            self.stats['429:global'] += 1
+            retry_after = max(self._global.reset - now, 0)
+            return self._json(
+                {'message': 'You are being rate limited.', 'retry_after': retry_after, 'global': True},
+                status=429,
+                headers={'Via': '1.1 google', 'X-RateLimit-Global': 'true', 'Retry-After': str(retry_after)}
+            )
+
+        key = (template, tuple(major))
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            limit, per = self.limits.get(template, (self.bucket_limit, self.bucket_per))
+            bucket = self.buckets[key] = Bucket(limit, per)
+
+        if not bucket.take(now):
+            self.stats['429:bucket'] += 1
+            headers = self._ratelimit_headers(template, bucket, now)
+            retry_after = max(bucket.reset - now, 0)
+            return self._json(
+                {'message': 'You are being rate limited.', 'retry_after': retry_after, 'global': False},
+                status=429,
+                headers=headers
+            )
+
+        headers = self._ratelimit_headers(template, bucket, now)
+        low, high = self.latency
+        if high > 0:
+            await asyncio.sleep(random.uniform(low, high))
+
+        if self.error_rate and random.random() < self.error_rate:
+            status = random.choice((500, 502))
+            self.stats[str(status)] += 1
+            return web.Response(status=status, text='Internal Server Error', headers=headers)
+
+        # Make sure the body is consumed like discord would
+        await request.read()
+        self.stats['2xx'] += 1
+        if request.method == 'DELETE' or template.endswith('/typing'):
+            return web.Response(status=204, headers=headers)
+
+        return self._json(self._payload(template, major), headers=headers)
+
+    def _payload(self, template, major):
+        last = template.rsplit('/', 1)[-1]
+        if last == 'audit-logs':
+            return {'audit_log_entries': [], 'users': [], 'webhooks': []}
+
+        if last in COLLECTIONS and template.startswith('GET '):
+            kind = last
+            return [self._object(kind, major) for _ in range(3)]
+
+        # Posting to a collection creates a single object
+        segments = template.split(' ', 1)[1].strip('/').split('/')
+        kind = segments[-2] if segments[-1].startswith('{') and len(segments) > 1 else segments[-1]
+        return self._object(kind, major)
+
+    def _object(self, kind, major):
+        user = {'id': _snowflake(), 'username': 'mock', 'discriminator': '0001', 'avatar': None,
+                'public_flags': 0}
+        if kind in ('guilds',):
+            guild_id = major[0] if major else _snowflake()
+            return {
+                'id': guild_id, 'name': 'Mock Guild', 'icon': None, 'owner_id': user['id'], 'permissions': '0',
+                'verification_level': 0, 'default_message_notifications': 0, 'explicit_content_filter': 0,
+                'mfa_level': 0, 'roles': [self._object('roles', [guild_id])], 'emojis': [], 'features': []
+            }
+        elif kind in ('channels', 'pins'):
+            return {'id': major[0] if kind == 'channels' and major and len(major) == 1 else _snowflake(),
+                    'type': 0, 'name': 'mock', 'position': 0, 'permission_overwrites': []}
+        elif kind == 'roles':
+            return {'id': _snowflake(), 'name': 'mock', 'permissions': '0', 'position': 0, 'color': 0,
+                    'hoist': False, 'mentionable': False}
+        elif kind in ('members', 'bans'):
+            return {'user': user, 'roles': [], 'joined_at': '2020-01-01T00:00:00.000000+00:00', 'deaf': False,
+                    'mute': False}
+        elif kind == 'messages':
+            return {'id': _snowflake(), 'type': 0, 'content': 'mock', 'author': user,
+                    'timestamp': '2020-01-01T00:00:00.000000+00:00', 'edited_timestamp': None,
+                    'channel_id': major[0] if major else _snowflake(), 'attachments': []}
+        elif kind == 'webhooks':
+            return {'id': _snowflake(), 'type': 1, 'token': 'mock', 'user': user,
+                    'channel_id': major[0] if major else _snowflake()}
+        elif kind == 'gateway' or kind == 'bot':
+            return {'url': 'wss://gateway.discord.gg', 'shards': 1}
+
+        return {'id': _snowflake(), **user}
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        if not self.port:
+            # Find out which port was picked
+            self.port = site._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()